@@ -62,6 +62,7 @@ CREATE TABLE `Event` (
   `location` varchar(255) NOT NULL,
   PRIMARY KEY (`id`),
   KEY `organizer` (`organizer`),
+  KEY `ix_Event_end_date_start_date` (`end_date`,`start_date`),
   CONSTRAINT `Event_ibfk_1` FOREIGN KEY (`organizer`) REFERENCES `User` (`id`)
 ) ENGINE=InnoDB AUTO_INCREMENT=5 DEFAULT CHARSET=latin1;
 /*!40101 SET character_set_client = @saved_cs_client */;
@@ -203,6 +204,33 @@ INSERT INTO `FoodPreference` VALUES (1,'Gluten Free','No gluten, which is found
 /*!40000 ALTER TABLE `FoodPreference` ENABLE KEYS */;
 UNLOCK TABLES;
 
+--
+-- Table structure for table `TokenRevocation`
+--
+
+DROP TABLE IF EXISTS `TokenRevocation`;
+/*!40101 SET @saved_cs_client     = @@character_set_client */;
+/*!40101 SET character_set_client = utf8 */;
+CREATE TABLE `TokenRevocation` (
+  `id` bigint(20) NOT NULL AUTO_INCREMENT,
+  `user_id` bigint(20) NOT NULL,
+  `time` datetime(3) NOT NULL,
+  PRIMARY KEY (`id`),
+  KEY `ix_TokenRevocation_user_id_time` (`user_id`,`time`),
+  KEY `ix_TokenRevocation_time` (`time`),
+  CONSTRAINT `TokenRevocation_ibfk_1` FOREIGN KEY (`user_id`) REFERENCES `User` (`id`)
+) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4 COLLATE=utf8mb4_unicode_ci;
+/*!40101 SET character_set_client = @saved_cs_client */;
+
+--
+-- Dumping data for table `TokenRevocation`
+--
+
+LOCK TABLES `TokenRevocation` WRITE;
+/*!40000 ALTER TABLE `TokenRevocation` DISABLE KEYS */;
+/*!40000 ALTER TABLE `TokenRevocation` ENABLE KEYS */;
+UNLOCK TABLES;
+
 --
 -- Table structure for table `User`
 --
@@ -222,7 +250,8 @@ CREATE TABLE `User` (
   `expo_token` varchar(255) COLLATE utf8mb4_unicode_ci DEFAULT NULL,
   `login_count` int(11) NOT NULL,
   PRIMARY KEY (`id`),
-  UNIQUE KEY `email` (`email`)
+  UNIQUE KEY `email` (`email`),
+  KEY `ix_User_status_id` (`status`,`id`)
 ) ENGINE=InnoDB AUTO_INCREMENT=5 DEFAULT CHARSET=utf8mb4 COLLATE=utf8mb4_unicode_ci;
 /*!40101 SET character_set_client = @saved_cs_client */;
 
@@ -262,6 +291,64 @@ LOCK TABLES `UserAcceptedEvent` WRITE;
 /*!40000 ALTER TABLE `UserAcceptedEvent` ENABLE KEYS */;
 UNLOCK TABLES;
 
+--
+-- Table structure for table `UserActivity`
+--
+
+DROP TABLE IF EXISTS `UserActivity`;
+/*!40101 SET @saved_cs_client     = @@character_set_client */;
+/*!40101 SET character_set_client = utf8 */;
+CREATE TABLE `UserActivity` (
+  `id` bigint(20) NOT NULL AUTO_INCREMENT,
+  `user_id` bigint(20) DEFAULT NULL,
+  `activity` enum('LOGIN','LOGOUT','ACTIVE','INACTIVE','BACKGROUND','REFRESH') COLLATE utf8mb4_unicode_ci NOT NULL,
+  `time` datetime NOT NULL,
+  PRIMARY KEY (`id`,`time`),
+  KEY `ix_UserActivity_user_id_time` (`user_id`,`time`)
+) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4 COLLATE=utf8mb4_unicode_ci
+/* daily partitions are added ahead and dropped after rollup by the retention job;
+   partitioned tables can't have foreign keys */
+PARTITION BY RANGE COLUMNS(`time`) (PARTITION `pmax` VALUES LESS THAN (MAXVALUE));
+/*!40101 SET character_set_client = @saved_cs_client */;
+
+--
+-- Dumping data for table `UserActivity`
+--
+
+LOCK TABLES `UserActivity` WRITE;
+/*!40000 ALTER TABLE `UserActivity` DISABLE KEYS */;
+/*!40000 ALTER TABLE `UserActivity` ENABLE KEYS */;
+UNLOCK TABLES;
+
+--
+-- Table structure for table `UserActivityDaily`
+--
+
+DROP TABLE IF EXISTS `UserActivityDaily`;
+/*!40101 SET @saved_cs_client     = @@character_set_client */;
+/*!40101 SET character_set_client = utf8 */;
+CREATE TABLE `UserActivityDaily` (
+  `id` bigint(20) NOT NULL AUTO_INCREMENT,
+  `day` date NOT NULL,
+  `user_id` bigint(20) DEFAULT NULL,
+  `activity` enum('LOGIN','LOGOUT','ACTIVE','INACTIVE','BACKGROUND','REFRESH') COLLATE utf8mb4_unicode_ci NOT NULL,
+  `count` int(11) NOT NULL,
+  PRIMARY KEY (`id`),
+  UNIQUE KEY `ix_UserActivityDaily_day_user_id_activity` (`day`,`user_id`,`activity`),
+  KEY `user_id` (`user_id`),
+  CONSTRAINT `UserActivityDaily_ibfk_1` FOREIGN KEY (`user_id`) REFERENCES `User` (`id`)
+) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4 COLLATE=utf8mb4_unicode_ci;
+/*!40101 SET character_set_client = @saved_cs_client */;
+
+--
+-- Dumping data for table `UserActivityDaily`
+--
+
+LOCK TABLES `UserActivityDaily` WRITE;
+/*!40000 ALTER TABLE `UserActivityDaily` DISABLE KEYS */;
+/*!40000 ALTER TABLE `UserActivityDaily` ENABLE KEYS */;
+UNLOCK TABLES;
+
 --
 -- Table structure for table `UserCheckedInEvent`
 --
@@ -315,6 +402,99 @@ LOCK TABLES `UserFoodPreference` WRITE;
 /*!40000 ALTER TABLE `UserFoodPreference` ENABLE KEYS */;
 UNLOCK TABLES;
 
+--
+-- Table structure for table `UserHostRequest`
+--
+
+DROP TABLE IF EXISTS `UserHostRequest`;
+/*!40101 SET @saved_cs_client     = @@character_set_client */;
+/*!40101 SET character_set_client = utf8 */;
+CREATE TABLE `UserHostRequest` (
+  `id` bigint(20) NOT NULL AUTO_INCREMENT,
+  `user` bigint(20) NOT NULL,
+  `reason` varchar(500) COLLATE utf8mb4_unicode_ci DEFAULT NULL,
+  `created` datetime NOT NULL,
+  `approved` datetime DEFAULT NULL,
+  `approved_by` bigint(20) DEFAULT NULL,
+  `primary_affiliation` smallint(6) DEFAULT NULL,
+  PRIMARY KEY (`id`),
+  UNIQUE KEY `user` (`user`),
+  KEY `approved_by` (`approved_by`),
+  KEY `primary_affiliation` (`primary_affiliation`),
+  KEY `ix_UserHostRequest_approved` (`approved`),
+  CONSTRAINT `UserHostRequest_ibfk_1` FOREIGN KEY (`user`) REFERENCES `User` (`id`),
+  CONSTRAINT `UserHostRequest_ibfk_2` FOREIGN KEY (`approved_by`) REFERENCES `User` (`id`),
+  CONSTRAINT `UserHostRequest_ibfk_3` FOREIGN KEY (`primary_affiliation`) REFERENCES `PrimaryAffiliation` (`id`)
+) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4 COLLATE=utf8mb4_unicode_ci;
+/*!40101 SET character_set_client = @saved_cs_client */;
+
+--
+-- Dumping data for table `UserHostRequest`
+--
+
+LOCK TABLES `UserHostRequest` WRITE;
+/*!40000 ALTER TABLE `UserHostRequest` DISABLE KEYS */;
+/*!40000 ALTER TABLE `UserHostRequest` ENABLE KEYS */;
+UNLOCK TABLES;
+
+--
+-- Table structure for table `UserLocation`
+--
+
+DROP TABLE IF EXISTS `UserLocation`;
+/*!40101 SET @saved_cs_client     = @@character_set_client */;
+/*!40101 SET character_set_client = utf8 */;
+CREATE TABLE `UserLocation` (
+  `user_id` bigint(20) NOT NULL,
+  `time` datetime NOT NULL,
+  `latitude` decimal(10,8) NOT NULL,
+  `longitude` decimal(11,8) NOT NULL,
+  PRIMARY KEY (`user_id`,`time`)
+) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4 COLLATE=utf8mb4_unicode_ci
+/* daily partitions are added ahead and dropped after rollup by the retention job;
+   partitioned tables can't have foreign keys */
+PARTITION BY RANGE COLUMNS(`time`) (PARTITION `pmax` VALUES LESS THAN (MAXVALUE));
+/*!40101 SET character_set_client = @saved_cs_client */;
+
+--
+-- Dumping data for table `UserLocation`
+--
+
+LOCK TABLES `UserLocation` WRITE;
+/*!40000 ALTER TABLE `UserLocation` DISABLE KEYS */;
+/*!40000 ALTER TABLE `UserLocation` ENABLE KEYS */;
+UNLOCK TABLES;
+
+--
+-- Table structure for table `UserLocationDaily`
+--
+
+DROP TABLE IF EXISTS `UserLocationDaily`;
+/*!40101 SET @saved_cs_client     = @@character_set_client */;
+/*!40101 SET character_set_client = utf8 */;
+CREATE TABLE `UserLocationDaily` (
+  `day` date NOT NULL,
+  `user_id` bigint(20) NOT NULL,
+  `pings` int(11) NOT NULL,
+  `first` datetime NOT NULL,
+  `last` datetime NOT NULL,
+  `latitude` decimal(10,8) NOT NULL,
+  `longitude` decimal(11,8) NOT NULL,
+  PRIMARY KEY (`day`,`user_id`),
+  KEY `user_id` (`user_id`),
+  CONSTRAINT `UserLocationDaily_ibfk_1` FOREIGN KEY (`user_id`) REFERENCES `User` (`id`)
+) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4 COLLATE=utf8mb4_unicode_ci;
+/*!40101 SET character_set_client = @saved_cs_client */;
+
+--
+-- Dumping data for table `UserLocationDaily`
+--
+
+LOCK TABLES `UserLocationDaily` WRITE;
+/*!40000 ALTER TABLE `UserLocationDaily` DISABLE KEYS */;
+/*!40000 ALTER TABLE `UserLocationDaily` ENABLE KEYS */;
+UNLOCK TABLES;
+
 --
 -- Table structure for table `UserRecommendedEvent`
 --
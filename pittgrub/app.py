@@ -12,14 +12,17 @@ import sys
 from typing import Dict, Any
 
 from tornado import concurrent, httpserver, log, web
-from tornado.ioloop import IOLoop
+from tornado.ioloop import IOLoop, PeriodicCallback
+from tornado.process import task_id
 from tornado.options import define, options, parse_command_line
 
 import db
 from handlers.admin import (
     HostApprovalHandler,
+    ReferenceDataHandler,
     UpdateUserThreshold
 )
+from handlers.base import log_request
 from handlers.events import (
     AcceptedEventHandler, 
     AcceptEventHandler,
@@ -51,8 +54,12 @@ from handlers.user import (
     UserProfileHandler,
     UserVerificationHandler
 )
-from service.auth import JwtTokenService
+from service.auth import JwtTokenService, configure_key_cache, configure_role_cache
+from service.credentials import CredentialService
 from service.property import init_cache
+from service.ratelimit import RateLimiter
+from service.retention import configure_retention, run_retention
+from service.revocation import init_revocations, sync_revocations
 from storage import ImageStore
 
 
@@ -70,33 +77,46 @@ class App(web.Application):
             self,
             debug: bool,
             token_service: JwtTokenService,
+            credential_service: CredentialService,
+            rate_limiter: RateLimiter=None,
+            db_threads: int=8,
+            slow_query_count: int=0,
+            slow_query_ms: float=0,
             static_path: str=None,
             rec_params: Dict[str, Any]=None,
             **db_config: Dict[str, str]) -> None:
         """Initialize application
 
         debug: debug mode enabled
+        token_service: token service
+        credential_service: password hashing service
+        rate_limiter: rate limiter for auth endpoints (default: None, no limits)
+        db_threads: threads running handlers' database work (default: 8)
+        slow_query_count: flag requests running more queries (default: 0, disabled)
+        slow_query_ms: flag requests spending more database time (default: 0, disabled)
         static_path: path for static files
         db_config: database config
         """
 
         # async task executors
         thread_pool = concurrent.futures.ThreadPoolExecutor(4)
+        # database work from handlers, bounded to stay within the connection pool
+        db_executor = concurrent.futures.ThreadPoolExecutor(db_threads)
 
         # tornado web app
         endpoints = [
             # index
             (r"/(/*)", MainHandler),
             # server status
-            (r"/health(/*)", HealthHandler),
+            (r"/health(/*)", HealthHandler, dict(token_service=token_service)),
             # email list
             (r'/email/add/([^/]+)', EmailListAddHandler),
             (r'/email/remove/([^/]+)', EmailListRemoveHandler),
             # login/singup
-            (r'/login(/*)', LoginHandler, dict(token_service=token_service)),
+            (r'/login(/*)', LoginHandler, dict(token_service=token_service, credential_service=credential_service)),
             (r'/logout(/*)', LogoutHandler, dict(token_service=token_service)),
-            (r'/signup(/*)', SignupHandler, dict(token_service=token_service)),
-            (r'/signup/host(/*)', HostSignupHandler, dict(token_service=token_service)),
+            (r'/signup(/*)', SignupHandler, dict(token_service=token_service, credential_service=credential_service)),
+            (r'/signup/host(/*)', HostSignupHandler, dict(token_service=token_service, credential_service=credential_service)),
             (r'/signup/host/affiliations(/*)', PrimaryAffiliationHandler, dict(token_service=token_service)),
             # token
             (r'/token/request(/*)', TokenRequestHandler, dict(token_service=token_service)),
@@ -105,13 +125,14 @@ class App(web.Application):
             # admin
             (r'/admin/approveHost(/*)', HostApprovalHandler, dict(token_service=token_service)),
             (r'/admin/updateUserThreshold(/*)', UpdateUserThreshold, dict(token_service=token_service)),
+            (r'/admin/reference/refresh(/*)', ReferenceDataHandler, dict(token_service=token_service)),
             # users
             (r'/users(/*)', UserHandler, dict(token_service=token_service)),
             (r'/users/profile(/*)', UserProfileHandler, dict(token_service=token_service)),
             (r'/users/location(/*)', UserLocationHandler, dict(token_service=token_service)),
             (r'/users/verify(/*)', UserVerificationHandler, dict(token_service=token_service)),
-            (r'/users/password', UserPasswordHandler, dict(token_service=token_service)),
-            (r'/users/password/reset(/*)', UserPasswordResetHandler, dict(token_service=token_service, executor=thread_pool)),
+            (r'/users/password', UserPasswordHandler, dict(token_service=token_service, credential_service=credential_service)),
+            (r'/users/password/reset(/*)', UserPasswordResetHandler, dict(token_service=token_service, credential_service=credential_service, executor=thread_pool)),
             # events
             (r'/events(/*)', EventHandler, dict(token_service=token_service, executor=thread_pool, rec_params=rec_params)),
             (r'/events/(\d+/*)', EventHandler, dict(token_service=token_service, executor=thread_pool, rec_params=rec_params)),
@@ -139,8 +160,9 @@ class App(web.Application):
         ]
 
         # server settings
-        settings = dict(static_path=static_path, debug=debug,)
-        web.Application.__init__(self, endpoints, settings)
+        settings = dict(static_path=static_path, debug=debug, rate_limiter=rate_limiter, db_executor=db_executor,
+                        log_function=log_request, slow_query_count=slow_query_count, slow_query_ms=slow_query_ms)
+        web.Application.__init__(self, endpoints, **settings)
 
         # initialize database
         db.init(
@@ -151,11 +173,20 @@ class App(web.Application):
             port=db_config['dbport'],
             database=db_config['database'],
             params=db_config['params'],
-            generate=db_config['generate'])
+            generate=db_config['generate'],
+            async_pool=db_config.get('async_pool', 0),
+            pool=db_config.get('pool'),
+            replicas=db_config.get('replicas'),
+            replica_pin=db_config.get('replica_pin', 5),
+            uri=db_config.get('uri'),
+            driver=db_config.get('driver', 'mysql+pymysql'))
 
         # initialize property cache
         init_cache()
 
+        # load revoked tokens and disabled users
+        init_revocations()
+
 
 def main():
     """Make application"""
@@ -174,12 +205,25 @@ def main():
 
     # database configuration
     db_config = config['DB']
+    uri = db_config.get('uri') or None
+    driver = db_config.get('driver', 'mysql+pymysql')
     username = db_config.get('username')
     password = db_config.get('password')
     url = db_config.get('url')
     dbport = db_config.get('port', '3306')
     database = db_config.get('database')
     generate = db_config.getboolean('generate')
+    db_threads = db_config.getint('executor_threads', 8)
+    async_pool = db_config.getint('async_pool', 0)
+    pool = dict(
+        pool_size=db_config.getint('pool_size', 5),
+        max_overflow=db_config.getint('max_overflow', 10),
+        pool_timeout=db_config.getfloat('pool_timeout', 30),
+        pool_recycle=db_config.getint('pool_recycle', 3600),
+        pool_pre_ping=db_config.getboolean('pool_pre_ping', False))
+    pool_stats_interval = db_config.getfloat('pool_stats_interval', 60)
+    replicas = [host.strip() for host in db_config.get('replicas', '').split(',') if host.strip()]
+    replica_pin = db_config.getfloat('replica_pin', 5)
     if config.has_option('DB', 'options'):
         # convert options to url parameters
         params = '?' + re.sub(',\s*', '&', db_config.get('options'))
@@ -187,13 +231,37 @@ def main():
         params = ''
 
     # token service configuration
-    token_service = JwtTokenService(server_config.get('secret'))
+    token_cache_size = config.getint('TOKEN', 'cache_size', fallback=0)
+    token_service = JwtTokenService(server_config.get('secret'), cache_size=token_cache_size)
+    if config.has_section('TOKEN'):
+        token_config = config['TOKEN']
+        configure_key_cache(
+            maxsize=token_config.getint('key_cache_size', 4096),
+            ttl=token_config.getfloat('key_cache_ttl', 300))
+        configure_role_cache(
+            maxsize=token_config.getint('role_cache_size', 4096),
+            ttl=token_config.getfloat('role_cache_ttl', 300))
+
+    # password hashing configuration
+    credential_service = CredentialService(server_config.getint('hash_procs', 2))
+
+    # rate limit configuration
+    # created before fork so buckets are shared by all processes
+    rate_limiter = None
+    if config.has_section('RATELIMIT'):
+        limit_config = config['RATELIMIT']
+        rate_limiter = RateLimiter(limit_config.getint('slots', 65536))
+        for name, budget in limit_config.items():
+            if name != 'slots' and budget:
+                rate_limiter.configure(name, budget)
 
     # logging configuration
     log_config = config['LOG']
     filename = log_config.get('file')
     level = log_config.get('level')
     fmt = log_config.get('format')
+    slow_query_count = log_config.getint('slow_query_count', 0)
+    slow_query_ms = log_config.getfloat('slow_query_ms', 0)
     logging.basicConfig(filename=filename, level=level, format=fmt)
 
     # reccommendation configuration
@@ -204,6 +272,11 @@ def main():
     app = App(
         debug=debug,
         token_service=token_service,
+        credential_service=credential_service,
+        rate_limiter=rate_limiter,
+        db_threads=db_threads,
+        slow_query_count=slow_query_count,
+        slow_query_ms=slow_query_ms,
         username=username,
         password=password,
         url=url,
@@ -211,18 +284,55 @@ def main():
         rec_params={'avg_prob': avg_prob_attnd},
         database=database,
         params=params,
-        generate=generate)
+        generate=generate,
+        async_pool=async_pool,
+        pool=pool,
+        replicas=replicas,
+        replica_pin=replica_pin,
+        uri=uri,
+        driver=driver)
 
     # start server
-    server = httpserver.HTTPServer(app)
+    server = httpserver.HTTPServer(app, xheaders=server_config.getboolean('xheaders', False))
+    if procs != 1 and db.is_embedded():
+        logging.warning('SQLite database is embedded, serving from a single process')
+        procs = 1
     if procs == 1:
         # single process
         server.listen(port)
         server.start()
     else:
         # multiple processes
+        # each worker opens its own database connections after fork
         server.bind(port)
+        db.dispose()
         server.start(procs)
+        db.init_worker()
+
+    # keep revocations in sync with other workers, off the IOLoop
+    revocation_sync = config.getfloat('TOKEN', 'revocation_sync', fallback=30)
+    PeriodicCallback(lambda: IOLoop.current().run_in_executor(app.settings['db_executor'], sync_revocations),
+                     revocation_sync * 1000).start()
+
+    # reload reference data refreshed by other workers, off the IOLoop
+    reference_sync = config.getfloat('DB', 'reference_sync', fallback=60)
+    PeriodicCallback(lambda: IOLoop.current().run_in_executor(app.settings['db_executor'], db.reference.sync),
+                     reference_sync * 1000).start()
+
+    # roll up and remove expired activity and locations, in one process only
+    retention_interval = config.getfloat('RETENTION', 'interval', fallback=0)
+    if retention_interval > 0 and task_id() in (None, 0):
+        configure_retention(
+            activity_days=config.getint('RETENTION', 'activity_days', fallback=90),
+            location_days=config.getint('RETENTION', 'location_days', fallback=30),
+            partitions_ahead=config.getint('RETENTION', 'partitions_ahead', fallback=7))
+        PeriodicCallback(lambda: IOLoop.current().run_in_executor(None, run_retention),
+                         retention_interval * 1000).start()
+
+    # log connection pool usage since last report
+    if pool_stats_interval > 0:
+        PeriodicCallback(lambda: logging.info(f'pool stats: {db.pool_stats(reset=True)}'),
+                         pool_stats_interval * 1000).start()
     IOLoop.current().start()
 
 
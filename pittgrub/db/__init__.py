@@ -1,26 +1,51 @@
+import hashlib
 import logging
+import os
+import random
 import sys
 from contextlib import contextmanager
 from datetime import datetime, timedelta
-from typing import Any, Dict
+from typing import Any, Dict, List, Optional
 
-from sqlalchemy import create_engine
+from sqlalchemy import create_engine, inspect, select
+from sqlalchemy.engine.url import make_url
 from sqlalchemy.orm import sessionmaker
+from sqlalchemy.pool import StaticPool
 
-from .base import Entity, ReferralStatus, UserStatus, health_check, Activity
+from . import aio, querystats, reference
+from .base import Entity, InvalidCursor, Page, ReferralStatus, UserStatus, health_check, Activity
 from .default import DEFAULTS
+from .pool import TimedQueuePool
+from .replica import PinTable
 from .schema import (
     Building, EmailList, Event, EventFoodPreference, EventImage,
     FoodPreference, Property, Role, User, UserAcceptedEvent,
     UserCheckedInEvent, UserFoodPreference, UserHostRequest,
     UserRecommendedEvent, UserReferral, UserRole, UserVerification,
-    UserLocation, UserActivity, PrimaryAffiliation
+    UserLocation, UserActivity, PrimaryAffiliation, TokenRevocation,
+    UserActivityDaily, UserLocationDaily
 )
 
 # database sessionmaker
 # initialized by init()
 Session = sessionmaker()
 
+# engine url and options, set by init()
+__engine_config = None
+
+# engine for this process
+# replaced in each worker by init_worker()
+__engine = None
+
+# read replica urls, set by init()
+__replica_urls = []
+
+# read replica engines for this process
+__replicas = []
+
+# users whose reads stay on the primary after writing
+__pins = None
+
 # database testing values
 # insert when 'generate' flag is True
 TEST_DATA = dict({
@@ -99,28 +124,107 @@ TEST_DATA = dict({
 })
 
 
-def __bulk_insert(engine, data: Dict[str, Any]):
+# property holding fingerprint of the last seeding
+SEED_PROPERTY = 'db.seed'
+
+
+def __seed_fingerprint(*datasets: Dict[str, Any]) -> str:
+    """Hash of table definitions and seed data, changes when either does"""
+    digest = hashlib.sha256()
+    for table in schema.Base.metadata.sorted_tables:
+        digest.update(repr((table.name, [(c.name, str(c.type)) for c in table.columns])).encode())
+    for data in datasets:
+        for entity in sorted(data):
+            digest.update(repr((entity, data[entity])).encode())
+    return digest.hexdigest()
+
+
+def __seeded_fingerprint(engine) -> Optional[str]:
+    """Fingerprint stored by the last seeding, if any"""
+    properties = Property.__table__
+    with engine.connect() as conn:
+        if not engine.dialect.has_table(conn, properties.name):
+            return None
+        return conn.execute(select([properties.c.value])
+                            .where(properties.c.name == SEED_PROPERTY)).scalar()
+
+
+def __upsert(session, cls: type, values: List[tuple]):
+    """Insert or update entities given as constructor arguments"""
+    # entity constructors map tuples to columns
+    columns = inspect(cls).column_attrs
+    rows = []
+    for i in values:
+        entity = cls(*i)
+        row = dict()
+        for attr in columns:
+            value = getattr(entity, attr.key)
+            column = attr.columns[0]
+            if value is not None or (column.default is None and column.server_default is None):
+                row[attr.key] = value
+        rows.append(row)
+    cls.bulk_upsert(session, rows)
+
+
+def __seed(engine, *datasets: Dict[str, Any], force: bool=False):
+    """
+    Create tables and upsert seed data in one transaction
+    Skipped when the fingerprint of tables and data is unchanged
+    """
+    fingerprint = __seed_fingerprint(*datasets)
+    if not force and __seeded_fingerprint(engine) == fingerprint:
+        logging.info('Seed data unchanged, skipping')
+        return
+
     schema.Base.metadata.create_all(bind=engine)
-    for entity, values in data.items():
-        # get class of entity
-        cls = getattr(sys.modules[__name__], entity)
-        # merge values
-        # this avoids duplicate errors
-        for i in values:
-            with session_scope() as session:
-                    session.merge(cls(*i))
+    with engine.begin() as conn:
+        session = Session(bind=conn)
+        for data in datasets:
+            for entity, values in data.items():
+                # get class of entity
+                cls = getattr(sys.modules[__name__], entity)
+                __upsert(session, cls, values)
+        prop = Property.get_by_name(session, SEED_PROPERTY) or Property(None, SEED_PROPERTY, fingerprint)
+        prop.value = fingerprint
+        prop.updated = datetime.utcnow()
+        session.add(prop)
+        session.flush()
+        session.close()
 
 
 @contextmanager
-def session_scope():
+def session_scope(readonly: bool=False, owner: int=None, primary: bool=False):
     """
     Provides a transactional scope around a series of operations
     http://docs.sqlalchemy.org/en/latest/orm/session_basics.html
+
+    :readonly: only read: no flush, no commit, and loaded objects aren't expired,
+               the transaction is rolled back at the end;
+               routed to a read replica, if configured
+    :owner:    user the work is for; their reads stay on the primary
+               for a short window after their own writes
+               (set session.info['owner'] when only known inside the scope)
+    :primary:  keep a readonly scope on the primary
     """
-    session = Session()
+    if readonly and not primary and __replicas and not (owner is not None and __pins.is_pinned(owner)):
+        session = Session(bind=random.choice(__replicas), autoflush=False, expire_on_commit=False)
+    elif readonly:
+        session = Session(autoflush=False, expire_on_commit=False)
+    else:
+        session = Session()
     try:
         yield session
-        session.commit()
+        if readonly:
+            if session.new or session.dirty or session.deleted:
+                logging.warning('discarding changes made in a read-only session')
+            # detach first, so rollback doesn't expire returned objects
+            session.expunge_all()
+            session.rollback()
+        else:
+            session.commit()
+            owner = owner if owner is not None else session.info.get('owner')
+            if owner is not None and __pins is not None:
+                __pins.pin(owner)
     except Exception as e:
         logging.error(f'\nA ROLLBACK OCCURRED\n{e}')
         session.rollback()
@@ -129,8 +233,9 @@ def session_scope():
         session.close()
 
 
-def init(username: str, password: str, url: str, database: str, port: str, params: str, echo: bool=False, generate: bool=False):
+def init(username: str=None, password: str=None, url: str=None, database: str=None, port: str=None, params: str='', echo: bool=False, generate: bool=False, async_pool: int=0, pool: Dict[str, Any]=None, replicas: List[str]=None, replica_pin: float=5, uri: str=None, driver: str='mysql+pymysql'):
     """Initialize database
+    Connects to uri if given, otherwise builds a driver url from the connection settings
 
     :username: username
     :password: user's password
@@ -140,19 +245,114 @@ def init(username: str, password: str, url: str, database: str, port: str, param
     :params:   parameters
     :echo:     log commands
     :generate: generate tables dynamically
+    :async_pool: async connections per process (0 to disable async access)
+    :pool:     connection pool options (pool_size, max_overflow, pool_timeout, pool_recycle, pool_pre_ping)
+    :replicas: read replica hosts, as host or host:port
+    :replica_pin: seconds a user's reads stay on the primary after their write
+    :uri:      full database url, e.g. sqlite:///pittgrub.db (overrides the connection settings)
+    :driver:   SQLAlchemy dialect+driver for the connection settings (default: mysql+pymysql)
     """
-    global Session
-    engine = create_engine(f'mysql+pymysql://{username}:{password}@{url}:{port}/{database}{params}',
-                           convert_unicode=True, echo=echo, pool_recycle=3600)
+    global Session, __engine, __engine_config, __replica_urls, __replicas, __pins
+    uri = uri or f'{driver}://{username}:{password}@{url}:{port}/{database}{params}'
+    embedded = is_embedded(uri)
+    options = dict(convert_unicode=True, echo=echo)
+    if embedded:
+        # pool settings don't apply to SQLite; handlers share the database across threads
+        options.update(connect_args=dict(check_same_thread=False))
+        if make_url(uri).database in (None, '', ':memory:'):
+            # an in-memory database only lives as long as its connection
+            options.update(poolclass=StaticPool)
+    else:
+        options.update(poolclass=TimedQueuePool, pool_recycle=3600)
+        options.update(pool or dict())
+    __engine_config = (uri, options)
+    engine = __engine = __make_engine()
     Session.configure(bind=engine)
     logging.info(f'connecting to {engine}')
+    if embedded and replicas:
+        logging.warning('read replicas are not supported on SQLite, ignoring')
+        replicas = None
+    if async_pool > 0 and make_url(uri).get_backend_name() != 'mysql':
+        logging.warning('async access is only supported on MySQL, ignoring')
+        async_pool = 0
+    if replicas:
+        __replica_urls = [
+            f'{driver}://{username}:{password}@{host}{"" if ":" in host else ":" + port}/{database}{params}'
+            for host in replicas]
+        __replicas = [__make_engine(replica) for replica in __replica_urls]
+        # created before fork, so pins are shared by all processes
+        __pins = PinTable(replica_pin)
+        logging.info(f'reading from {len(__replicas)} replicas')
+    if async_pool > 0:
+        primary = make_url(uri)
+        aio.configure(primary.username, primary.password, primary.host, primary.database,
+                      str(primary.port or 3306), maxsize=async_pool)
     logging.info('Inserting default data')
 
     if generate:
         schema.Base.metadata.drop_all(bind=engine)
         logging.warning('Inserting test data')
         # add test data if generate flag is set to true
-        __bulk_insert(engine, DEFAULTS)
-        __bulk_insert(engine, TEST_DATA)
+        __seed(engine, DEFAULTS, TEST_DATA, force=True)
     else:
-        __bulk_insert(engine, DEFAULTS)
+        __seed(engine, DEFAULTS)
+
+    # loaded before any session uses it, and before fork, so workers start with it
+    reference.load()
+
+
+def is_embedded(uri: str=None) -> bool:
+    """
+    Check if database is embedded (SQLite), so it must be served by a single process
+    :param uri: database url (default: initialized database)
+    """
+    if uri is None:
+        assert __engine_config is not None, 'Database not initialized'
+        uri = __engine_config[0]
+    return make_url(uri).get_backend_name() == 'sqlite'
+
+
+def __make_engine(url: str=None):
+    primary, options = __engine_config
+    engine = create_engine(url or primary, **options)
+    querystats.instrument(engine)
+    return engine
+
+
+def dispose():
+    """
+    Close pooled connections
+    Must be called before forking, so workers don't share the parent's connections
+    """
+    if __engine is not None:
+        __engine.dispose()
+        for replica in __replicas:
+            replica.dispose()
+        logging.info('disposed database connections before fork')
+
+
+def init_worker():
+    """
+    Create this process's engine and connection pool
+    Must be called in each worker after forking
+    """
+    global __engine, __replicas
+    assert __engine_config is not None, 'Database not initialized'
+    # the inherited engines' pools are empty after dispose(),
+    # so they are dropped rather than disposed again
+    __engine = __make_engine()
+    __replicas = [__make_engine(replica) for replica in __replica_urls]
+    Session.configure(bind=__engine)
+
+
+def pool_stats(reset: bool=False) -> Optional[Dict[str, Any]]:
+    """
+    Connection pool statistics for this process
+    :param reset: reset wait counters after reading (default: False)
+    :return: pool statistics, or None if pool doesn't record them
+    """
+    if __engine is None or not isinstance(__engine.pool, TimedQueuePool):
+        return None
+    stats = __engine.pool.stats(reset)
+    stats['pid'] = os.getpid()
+    return stats
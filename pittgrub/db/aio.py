@@ -0,0 +1,101 @@
+"""
+Asynchronous database access
+Hot queries run as coroutines on the IOLoop with aiomysql,
+next to the synchronous session_scope
+"""
+
+import logging
+
+try:
+    from aiomysql.sa import create_engine
+except ImportError:
+    create_engine = None
+
+
+# aiomysql connection settings, set by configure()
+__config = None
+
+# engine for this process, created on first use
+# so each forked server process gets its own connections
+__engine = None
+
+
+def configure(username: str, password: str, url: str, database: str, port: str, maxsize: int=10):
+    """
+    Enable async database access
+
+    :username: username
+    :password: user's password
+    :url:      database url
+    :database: database name
+    :port:     database port
+    :maxsize:  maximum connections per process
+    """
+    global __config
+    if create_engine is None:
+        logging.warning('aiomysql is not installed, async database access disabled')
+        return
+    __config = dict(
+        user=username,
+        password=password,
+        host=url,
+        port=int(port),
+        db=database,
+        charset='utf8mb4',
+        minsize=1,
+        maxsize=maxsize,
+        pool_recycle=3600)
+
+
+def available() -> bool:
+    """Check if async database access is configured"""
+    return __config is not None
+
+
+async def get_engine():
+    global __engine
+    if __engine is None:
+        assert __config is not None, 'Async database access not configured'
+        __engine = await create_engine(**__config)
+        logging.info(f'connected async engine to {__config["host"]}')
+    return __engine
+
+
+async def dispose():
+    """Close this process's async connections"""
+    global __engine
+    if __engine is not None:
+        engine, __engine = __engine, None
+        engine.close()
+        await engine.wait_closed()
+
+
+class async_session_scope:
+    """
+    Provides a transactional scope around a series of async operations
+    Yields an aiomysql.sa connection for SQLAlchemy core statements
+
+        async with async_session_scope() as conn:
+            result = await conn.execute(select([User.__table__]))
+    """
+
+    def __init__(self):
+        self._conn = None
+        self._transaction = None
+
+    async def __aenter__(self):
+        engine = await get_engine()
+        self._conn = await engine.acquire()
+        self._transaction = await self._conn.begin()
+        return self._conn
+
+    async def __aexit__(self, exc_type, exc, tb):
+        try:
+            if exc_type is None:
+                await self._transaction.commit()
+            else:
+                logging.error(f'\nA ROLLBACK OCCURRED\n{exc}')
+                await self._transaction.rollback()
+        finally:
+            await self._conn.close()
+            self._conn = self._transaction = None
@@ -1,9 +1,17 @@
+import base64
+import binascii
+import datetime
 import enum
+import json
 import logging
-from typing import List, Optional, Type, TypeVar, Union
+from collections import defaultdict
+from typing import Any, Callable, Dict, List, NamedTuple, Optional, Sequence, Type, TypeVar, Union
 
 from passlib.hash import bcrypt_sha256
-from sqlalchemy import String, TypeDecorator
+from sqlalchemy import String, TypeDecorator, and_, inspect, or_
+from sqlalchemy.dialects.mysql import insert as mysql_insert
+from sqlalchemy.ext.compiler import compiles
+from sqlalchemy.sql.expression import Insert
 from sqlalchemy.types import CHAR
 
 import db
@@ -15,7 +23,7 @@ E = TypeVar('Entity', bound='Entity')
 
 def health_check() -> bool:
     try:
-        with db.session_scope() as session:
+        with db.session_scope(readonly=True, primary=True) as session:
             session.execute('SELECT 1')
         return True
     except Exception as e:
@@ -23,17 +31,124 @@ def health_check() -> bool:
         return False
 
 
+class InvalidCursor(ValueError):
+    """Page cursor is malformed or belongs to another listing"""
+    pass
+
+
+class Page(NamedTuple):
+    """One page of a keyset paginated listing"""
+    items: List[Any]
+    # cursor of the next page, None on the last page
+    next: Optional[str]
+
+
+# rows per multi-row statement of the bulk helpers
+BULK_CHUNK = 1000
+
+
+class SQLiteUpsert(Insert):
+    """
+    INSERT ... ON CONFLICT (primary key) DO UPDATE SET (SQLite 3.24+)
+    SQLAlchemy 1.3 has no SQLite upsert construct
+    :param updates: columns set from the inserted row on conflict (none: DO NOTHING)
+    """
+
+    def __init__(self, table, updates: Sequence[str]):
+        super().__init__(table)
+        self.updates = updates
+
+
+@compiles(SQLiteUpsert, 'sqlite')
+def _compile_sqlite_upsert(insert: SQLiteUpsert, compiler, **kw) -> str:
+    quote = compiler.preparer.quote
+    keys = ', '.join(quote(column.name) for column in insert.table.primary_key)
+    if insert.updates:
+        action = 'DO UPDATE SET ' + ', '.join(f'{quote(key)} = excluded.{quote(key)}' for key in insert.updates)
+    else:
+        action = 'DO NOTHING'
+    return f'{compiler.visit_insert(insert, **kw)} ON CONFLICT ({keys}) {action}'
+
+# datetimes in cursors
+_CURSOR_TIME = '%Y-%m-%dT%H:%M:%S.%f'
+
+
+def encode_cursor(values: Sequence[Any]) -> str:
+    """Opaque cursor for the sort key values of a page's last item"""
+    data = [{'t': v.strftime(_CURSOR_TIME)} if isinstance(v, datetime.datetime) else v for v in values]
+    return base64.urlsafe_b64encode(json.dumps(data, separators=(',', ':')).encode()).decode().rstrip('=')
+
+
+def decode_cursor(cursor: str, size: int) -> List[Any]:
+    """
+    Sort key values of cursor
+    :param cursor: cursor from encode_cursor
+    :param size: number of sort key columns
+    :raises InvalidCursor: if cursor is malformed or has another number of values
+    """
+    try:
+        data = json.loads(base64.urlsafe_b64decode(cursor + '=' * (-len(cursor) % 4)))
+        if not isinstance(data, list) or len(data) != size:
+            raise ValueError(f'expected {size} values')
+        return [datetime.datetime.strptime(v['t'], _CURSOR_TIME) if isinstance(v, dict) else v for v in data]
+    except (binascii.Error, ValueError, TypeError, KeyError):
+        raise InvalidCursor(f'Invalid cursor: {cursor}')
+
+
+def keyset_filter(order: Sequence, cursor: str):
+    """
+    Condition for rows after cursor in order (ascending)
+    Written as (a > x) OR (a = x AND b > y) rather than a row comparison,
+    so MySQL can use an index on the sort key
+    :raises InvalidCursor: if cursor doesn't match order
+    """
+    values = decode_cursor(cursor, len(order))
+    return or_(*[
+        and_(*[order[j] == values[j] for j in range(i)], column > values[i])
+        for i, column in enumerate(order)
+    ])
+
+
+def paginate(query, order: Sequence, limit: int, cursor: str=None, key: Callable[[Any], Sequence[Any]]=None) -> Page:
+    """
+    Keyset pagination
+    Each page is an index range scan from the previous page's last sort key,
+    so its cost doesn't grow with how far into the listing it is
+
+    :param query: query to page
+    :param order: sort key columns, ascending and unique together (e.g. start_date, id)
+    :param limit: page size
+    :param cursor: cursor of the page (default: first page)
+    :param key: sort key values of a result (default: its attributes named after order)
+    :raises InvalidCursor: if cursor doesn't match order
+    """
+    if cursor is not None:
+        query = query.filter(keyset_filter(order, cursor))
+    # one extra result tells if there is a next page
+    results = query.order_by(*order).limit(limit + 1).all()
+    if len(results) <= limit:
+        return Page(results, None)
+    results = results[:limit]
+    last = results[-1]
+    return Page(results, encode_cursor(key(last) if key else [getattr(last, column.key) for column in order]))
+
+
 class Entity:
     """Base queries for entities"""
 
     @classmethod
-    def get_all(cls: Type[E], session) -> List[Type[E]]:
-        entities = session.query(cls).all()
+    def get_all(cls: Type[E], session, options: Sequence=()) -> List[Type[E]]:
+        entities = session.query(cls).options(*options).all()
         return entities
 
     @classmethod
-    def get_by_id(cls: Type[E], session, entity_id: Union[int, str]) -> Optional[Type[E]]:
-        entity = session.query(cls).get(entity_id)
+    def get_page(cls: Type[E], session, limit: int, cursor: str=None, options: Sequence=()) -> Page:
+        """Entities in id order, one page at a time (see paginate)"""
+        return paginate(session.query(cls).options(*options), (cls.id,), limit, cursor)
+
+    @classmethod
+    def get_by_id(cls: Type[E], session, entity_id: Union[int, str], options: Sequence=()) -> Optional[Type[E]]:
+        entity = session.query(cls).options(*options).get(entity_id)
         return entity
 
     @classmethod
@@ -43,6 +158,76 @@ class Entity:
             .delete()
         return success
 
+    # Bulk writes
+    # Core statements of many rows each, instead of a flush per object
+    # They bypass the session's identity map: loaded entities aren't updated
+
+    @classmethod
+    def _bulk_rows(cls, rows: Sequence[Dict[str, Any]]) -> Dict[tuple, List[Dict[str, Any]]]:
+        """Rows keyed by attribute name as rows keyed by column, grouped by their columns"""
+        columns = {attr.key: attr.columns[0].key for attr in inspect(cls).column_attrs}
+        groups = defaultdict(list)
+        for row in rows:
+            values = {columns[key]: value for key, value in row.items()}
+            groups[tuple(sorted(values))].append(values)
+        return groups
+
+    @classmethod
+    def bulk_insert(cls: Type[E], session, rows: Sequence[Dict[str, Any]]) -> int:
+        """
+        Insert rows in multi-row INSERTs
+        :param session: database session
+        :param rows: attribute values of each row (column defaults apply to the rest)
+        :return: number of rows inserted
+        """
+        table = cls.__table__
+        for group in cls._bulk_rows(rows).values():
+            for i in range(0, len(group), BULK_CHUNK):
+                session.execute(table.insert().values(group[i:i + BULK_CHUNK]))
+        return len(rows)
+
+    @classmethod
+    def bulk_upsert(cls: Type[E], session, rows: Sequence[Dict[str, Any]]):
+        """
+        Insert rows, updating the given columns of rows whose primary key exists
+        Rows of only key columns are inserted if missing
+        One multi-row statement per chunk on MySQL and SQLite, a statement per row elsewhere
+        :param session: database session
+        :param rows: attribute values of each row, including its primary key
+        """
+        table = cls.__table__
+        dialect = session.get_bind().dialect.name
+        for keys, group in cls._bulk_rows(rows).items():
+            updates = [key for key in keys if not table.c[key].primary_key]
+            if dialect == 'mysql' and updates:
+                stmt = mysql_insert(table)
+                stmt = stmt.on_duplicate_key_update({key: stmt.inserted[key] for key in updates})
+            elif dialect == 'mysql':
+                stmt = table.insert().prefix_with('IGNORE')
+            elif dialect == 'sqlite':
+                stmt = SQLiteUpsert(table, updates)
+            else:
+                # no upsert statement, update and insert if missing
+                for row in group:
+                    key = and_(*[column == row[column.key] for column in table.primary_key])
+                    if not session.execute(table.update().where(key).values(row)).rowcount:
+                        session.execute(table.insert().values(row))
+                continue
+            for i in range(0, len(group), BULK_CHUNK):
+                session.execute(stmt.values(group[i:i + BULK_CHUNK]))
+
+    @classmethod
+    def bulk_delete(cls: Type[E], session, *criteria) -> int:
+        """
+        Delete rows matching criteria in one DELETE
+            UserFoodPreference.bulk_delete(session, UserFoodPreference.user_id == user_id)
+        :param session: database session
+        :param criteria: conditions on columns, all required (at least one)
+        :return: number of rows deleted
+        """
+        assert criteria, 'bulk_delete requires criteria'
+        return session.execute(cls.__table__.delete().where(and_(*criteria))).rowcount
+
 
 class Password(TypeDecorator):
     """Password hash
@@ -55,6 +240,10 @@ class Password(TypeDecorator):
         return value if value is not None else None
 
     def process_bind_param(self, value: str, dialect) -> str:
+        # values already hashed off the IOLoop (see service.credentials)
+        # are stored as is
+        if value is None or bcrypt_sha256.identify(value):
+            return value
         return bcrypt_sha256.hash(value)
 
     def process_result_value(self, value: str, dialect) -> str:
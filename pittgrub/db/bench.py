@@ -0,0 +1,92 @@
+"""
+Bulk write benchmarks
+Times Entity.bulk_insert, bulk_upsert and bulk_delete against
+the per-row ORM path they replace (session.add, session.merge and
+session.delete, flushed row by row), on UserRecommendedEvent rows
+
+Runs on an embedded SQLite database (from pittgrub/):
+    python -m db.bench [rows]
+"""
+
+import datetime
+import logging
+import sys
+import time
+from typing import Any, Callable, Dict, List, Tuple
+
+import db
+from db import UserRecommendedEvent, session_scope
+from db.explain import capture
+
+
+# event the benchmark rows are recommendations of
+EVENT_ID = 1
+
+
+def _rows(n: int, at: datetime.datetime) -> List[Dict[str, Any]]:
+    return [dict(event_id=EVENT_ID, user_id=user_id, time=at) for user_id in range(1, n + 1)]
+
+
+def orm_insert(session, rows: List[Dict[str, Any]]):
+    for row in rows:
+        session.add(UserRecommendedEvent(**row))
+        session.flush()
+
+
+def orm_upsert(session, rows: List[Dict[str, Any]]):
+    for row in rows:
+        session.merge(UserRecommendedEvent(**row))
+        session.flush()
+
+
+def orm_delete(session, rows: List[Dict[str, Any]]):
+    for entity in session.query(UserRecommendedEvent).filter(UserRecommendedEvent.event_id == EVENT_ID):
+        session.delete(entity)
+        session.flush()
+
+
+def bulk_delete(session, rows: List[Dict[str, Any]]):
+    UserRecommendedEvent.bulk_delete(session, UserRecommendedEvent.event_id == EVENT_ID)
+
+
+# name -> (rows present before the run, per-row write, bulk write)
+BENCHMARKS = {
+    'insert': (0, orm_insert, UserRecommendedEvent.bulk_insert),
+    'upsert': (0.5, orm_upsert, UserRecommendedEvent.bulk_upsert),
+    'delete': (1, orm_delete, bulk_delete),
+}   # type: Dict[str, Tuple[float, Callable, Callable]]
+
+
+def run(write: Callable, n: int, existing: float) -> Tuple[float, int]:
+    """
+    Time write of n rows, in a transaction rolled back afterwards
+    :param existing: fraction of the rows inserted before the write
+    :return: (seconds, statements executed)
+    """
+    now = datetime.datetime.utcnow()
+    with session_scope() as session:
+        UserRecommendedEvent.bulk_insert(session, _rows(int(n * existing), now - datetime.timedelta(days=1)))
+        rows = _rows(n, now)
+        start = time.perf_counter()
+        statements = capture(session, lambda session: write(session, rows))
+        elapsed = time.perf_counter() - start
+        session.rollback()
+    return elapsed, len(statements)
+
+
+def main(n: str='10000') -> int:
+    n = int(n)
+    db.init(uri='sqlite://')
+    print(f'{n} rows')
+    for name, (existing, orm_write, bulk_write) in BENCHMARKS.items():
+        orm_time, orm_statements = run(orm_write, n, existing)
+        bulk_time, bulk_statements = run(bulk_write, n, existing)
+        print(f'{name}: per-row {orm_time:.3f}s ({orm_statements} statements), '
+              f'bulk {bulk_time:.3f}s ({bulk_statements} statements), '
+              f'{orm_time / bulk_time:.1f}x')
+    return 0
+
+
+if __name__ == '__main__':
+    logging.basicConfig(level=logging.WARNING)
+    sys.exit(main(*sys.argv[1:2]))
@@ -0,0 +1,131 @@
+"""
+Query plan checks for hot queries
+Runs each named query, EXPLAINs the statements it executes,
+and fails if any of them scans a whole table
+
+Run against a database with realistic data (from pittgrub/):
+    python -m db.explain [config.ini]
+"""
+
+import configparser
+import datetime
+import logging
+import re
+import sys
+from typing import Any, Callable, List, Tuple
+
+from sqlalchemy import event
+
+import db
+from db import Event, TokenRevocation, User, UserActivity, UserHostRequest, session_scope
+
+
+# named hot queries, each run in a session
+HOT_QUERIES = {
+    'Event.get_all_active': lambda session: Event.get_all_active(session),
+    'Event.get_all_active_by_user': lambda session: Event.get_all_active_by_user(session, 1, 50),
+    'User.next_users_to_permit': lambda session: User.next_users_to_permit(session),
+    'UserHostRequest.get_pending_page': lambda session: UserHostRequest.get_pending_page(session, 50),
+    'UserActivity.get_by_user': lambda session: UserActivity.get_by_user(
+        session, 1, datetime.datetime.utcnow() - datetime.timedelta(days=30)),
+    'TokenRevocation.get_latest_by_user': lambda session: TokenRevocation.get_latest_by_user(session),
+    'TokenRevocation.get_since': lambda session: TokenRevocation.get_since(
+        session, datetime.datetime.utcnow() - datetime.timedelta(minutes=1)),
+}
+
+
+def capture(session, query: Callable[[Any], Any]) -> List[Tuple[str, Any]]:
+    """
+    Run query, recording the statements it executes
+    :return: (statement, parameters) pairs
+    """
+    statements = []
+
+    def record(conn, cursor, statement, parameters, context, executemany):
+        statements.append((statement, parameters))
+
+    engine = session.get_bind()
+    event.listen(engine, 'before_cursor_execute', record)
+    try:
+        query(session)
+    finally:
+        event.remove(engine, 'before_cursor_execute', record)
+    return statements
+
+
+def full_scans(session, statement: str, parameters: Any) -> Tuple[List[str], List[str]]:
+    """
+    EXPLAIN statement
+    :return: (plan lines, tables scanned in full)
+    """
+    connection = session.connection()
+    cursor = connection.connection.cursor()
+    try:
+        if connection.dialect.name == 'sqlite':
+            cursor.execute(f'EXPLAIN QUERY PLAN {statement}', parameters)
+            plan = [row[-1] for row in cursor.fetchall()]
+            # derived tables (e.g. a page of ids) are bounded by their own LIMIT
+            derived = {m.group(1) for m in (re.match(r'MATERIALIZE "?(\w+)"?', line) for line in plan) if m}
+            scans = [m.group(1) for m in (re.match(r'SCAN (?:TABLE )?"?(\w+)"?(.*)$', line) for line in plan)
+                     if m and 'INDEX' not in m.group(2) and m.group(1) not in derived]
+        else:
+            cursor.execute(f'EXPLAIN {statement}', parameters)
+            columns = [d[0] for d in cursor.description]
+            rows = [dict(zip(columns, row)) for row in cursor.fetchall()]
+            plan = [f"{r['table']}: type={r['type']} key={r['key']} rows={r['rows']} {r.get('Extra') or ''}" for r in rows]
+            scans = [r['table'] for r in rows if r['type'] == 'ALL' and not r['table'].startswith('<derived')]
+    finally:
+        cursor.close()
+    return plan, scans
+
+
+def check(names: List[str]=None) -> bool:
+    """
+    EXPLAIN hot queries
+    :param names: queries to check (default: all)
+    :return: True if every query runs and none scans a whole table
+    """
+    passed = True
+    for name in names or HOT_QUERIES:
+        with session_scope() as session:
+            try:
+                statements = capture(session, HOT_QUERIES[name])
+            except Exception as e:
+                print(f'{name}: ERROR {e}')
+                session.rollback()
+                passed = False
+                continue
+            for statement, parameters in statements:
+                plan, scans = full_scans(session, statement, parameters)
+                status = f'FULL SCAN of {", ".join(scans)}' if scans else 'OK'
+                print(f'{name}: {status}')
+                for line in plan:
+                    print(f'    {line}')
+                passed = passed and not scans
+            session.rollback()
+    return passed
+
+
+def main(config_file: str='config.ini') -> int:
+    config = configparser.ConfigParser()
+    config.read(config_file)
+    db_config = config['DB']
+    if db_config.get('options'):
+        params = '?' + re.sub(r',\s*', '&', db_config.get('options'))
+    else:
+        params = ''
+    db.init(
+        username=db_config.get('username'),
+        password=db_config.get('password'),
+        url=db_config.get('url'),
+        port=db_config.get('port', '3306'),
+        database=db_config.get('database'),
+        params=params,
+        uri=db_config.get('uri') or None,
+        driver=db_config.get('driver', 'mysql+pymysql'))
+    return 0 if check() else 1
+
+
+if __name__ == '__main__':
+    logging.basicConfig(level=logging.WARNING)
+    sys.exit(main(*sys.argv[1:2]))
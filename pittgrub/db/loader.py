@@ -0,0 +1,42 @@
+"""
+Loader profiles
+Named eager loading options for queries whose results become domain data,
+so relationships are loaded in a fixed number of queries instead of per row
+
+    events = Event.get_all_active(session, loader.EVENT)
+"""
+
+from sqlalchemy.orm import configure_mappers, joinedload, selectinload
+
+from .schema import (
+    Event,
+    User,
+    UserHostRequest
+)
+
+# backref attributes (e.g. User._user_roles) only exist once mappers are configured
+configure_mappers()
+
+
+# roles and food preferences themselves come from db.reference,
+# so only the association rows are loaded
+
+# User -> UserData (roles)
+USER = (
+    selectinload(User._user_roles),
+)
+
+# User -> UserProfileData (food preferences)
+USER_PROFILE = (
+    selectinload(User._user_foodpreferences),
+)
+
+# Event -> EventData (food preferences)
+EVENT = (
+    selectinload(Event._event_foodpreferences),
+)
+
+# UserHostRequest -> UserHostRequestData (user, user's affiliation)
+HOST_REQUEST = (
+    joinedload(UserHostRequest.user).joinedload(User.affiliation),
+)
@@ -0,0 +1,61 @@
+"""
+Connection pool with wait time statistics
+Tells pool starvation apart from slow queries
+"""
+
+import threading
+import time
+from typing import Any, Dict
+
+from sqlalchemy.exc import TimeoutError
+from sqlalchemy.pool import QueuePool
+
+
+class TimedQueuePool(QueuePool):
+    """QueuePool which records how long checkouts wait for a connection"""
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._stats_lock = threading.Lock()
+        self._waits = 0
+        self._wait_total = 0.0
+        self._wait_max = 0.0
+        self._timeouts = 0
+
+    def _do_get(self):
+        start = time.monotonic()
+        timed_out = False
+        try:
+            return super()._do_get()
+        except TimeoutError:
+            timed_out = True
+            raise
+        finally:
+            wait = time.monotonic() - start
+            with self._stats_lock:
+                self._waits += 1
+                self._wait_total += wait
+                self._wait_max = max(self._wait_max, wait)
+                self._timeouts += timed_out
+
+    def stats(self, reset: bool=False) -> Dict[str, Any]:
+        """
+        Pool statistics
+        :param reset: reset wait counters after reading (default: False)
+        :return: connection counts and checkout wait times (ms)
+        """
+        with self._stats_lock:
+            stats = dict(
+                size=self.size(),
+                checked_out=self.checkedout(),
+                idle=self.checkedin(),
+                overflow=max(self.overflow(), 0),
+                max_overflow=self._max_overflow,
+                checkouts=self._waits,
+                wait_avg_ms=round(1000 * self._wait_total / self._waits, 3) if self._waits else 0.0,
+                wait_max_ms=round(1000 * self._wait_max, 3),
+                timeouts=self._timeouts)
+            if reset:
+                self._waits = self._timeouts = 0
+                self._wait_total = self._wait_max = 0.0
+        return stats
@@ -0,0 +1,71 @@
+"""
+Per-request query statistics
+Counts the statements run by database work under run() and the time they take,
+so requests with N+1 query patterns or slow queries show up in the access log
+"""
+
+import threading
+import time
+from typing import Any, Callable
+
+from sqlalchemy import event
+
+
+# statistics of the request whose database work this thread is running
+_local = threading.local()
+
+
+class QueryStats:
+    """Statement count, total database time and slowest statement of a request"""
+
+    __slots__ = ('count', 'time', 'slowest', 'slowest_time', '_lock')
+
+    def __init__(self):
+        self.count = 0
+        self.time = 0.0
+        self.slowest = None
+        self.slowest_time = 0.0
+        self._lock = threading.Lock()
+
+    def add(self, statement: str, elapsed: float):
+        with self._lock:
+            self.count += 1
+            self.time += elapsed
+            if elapsed > self.slowest_time:
+                self.slowest, self.slowest_time = statement, elapsed
+
+    def __str__(self) -> str:
+        return f'{self.count} queries {1000 * self.time:.2f}ms'
+
+
+def run(stats: QueryStats, fn: Callable[..., Any], *args, **kwargs) -> Any:
+    """
+    Call fn, recording the statements it executes in stats
+    :param stats: request's statistics
+    :param fn: function to call
+    :return: fn's result
+    """
+    previous = getattr(_local, 'stats', None)
+    _local.stats = stats
+    try:
+        return fn(*args, **kwargs)
+    finally:
+        _local.stats = previous
+
+
+def instrument(engine):
+    """Record statements executed on engine"""
+    event.listen(engine, 'before_cursor_execute', _before_cursor_execute)
+    event.listen(engine, 'after_cursor_execute', _after_cursor_execute)
+
+
+def _before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    if getattr(_local, 'stats', None) is not None:
+        conn.info.setdefault('query_start', []).append(time.perf_counter())
+
+
+def _after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    stats = getattr(_local, 'stats', None)
+    starts = conn.info.get('query_start')
+    if stats is not None and starts:
+        stats.add(statement, time.perf_counter() - starts.pop())
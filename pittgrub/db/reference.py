@@ -0,0 +1,155 @@
+"""
+Reference data
+Role, FoodPreference and PrimaryAffiliation are small and rarely change,
+so each worker keeps them in memory and looks entries up by id or name
+without a query
+
+Entries are namedtuples of their table's columns. Changes to the tables
+are picked up by refresh(), which bumps the reference.version property;
+other workers reload when sync() sees the new version.
+A lookup that misses reloads once, at most every MISS_RELOAD seconds,
+so rows added without a refresh are still found
+"""
+
+import logging
+import threading
+import time
+from collections import namedtuple
+from typing import Any, Dict, Iterable, List, Optional, Tuple
+
+from sqlalchemy import inspect
+
+import db
+from .schema import FoodPreference, PrimaryAffiliation, Property, Role
+
+
+# version of the reference tables, bumped by refresh()
+VERSION_PROPERTY = 'reference.version'
+
+# minimum seconds between reloads on a lookup miss
+MISS_RELOAD = 10
+
+# reference tables
+TABLES = (Role, FoodPreference, PrimaryAffiliation)
+
+# entry type of each table
+_ENTRIES = {
+    model: namedtuple(model.__name__, [attr.key for attr in inspect(model).column_attrs])
+    for model in TABLES
+}
+
+# model -> (entries by id, entries by name)
+__entries = dict()  # type: Dict[type, Tuple[Dict[int, Any], Dict[str, Any]]]
+
+# version loaded
+__version = None
+
+# time of the last load (time.monotonic)
+__loaded = 0.0
+
+__lock = threading.Lock()
+
+
+def _version(session) -> Optional[str]:
+    return session.query(Property.value).filter(Property.name == VERSION_PROPERTY).scalar()
+
+
+def load():
+    """Load all reference tables"""
+    global __entries, __version, __loaded
+    with db.session_scope(readonly=True, primary=True) as session:
+        version = _version(session)
+        entries = dict()
+        for model, entry in _ENTRIES.items():
+            rows = [entry(*row) for row in session.query(*[getattr(model, key) for key in entry._fields])]
+            entries[model] = ({row.id: row for row in rows}, {row.name: row for row in rows})
+    with __lock:
+        __entries = entries
+        __version = version
+        __loaded = time.monotonic()
+    logging.info(f'loaded reference data version {version}: '
+                 + ', '.join(f'{len(by_id)} {model.__name__}' for model, (by_id, _) in entries.items()))
+
+
+def sync():
+    """Reload reference tables if another worker refreshed them"""
+    with db.session_scope(readonly=True, primary=True) as session:
+        version = _version(session)
+    if version != __version:
+        load()
+
+
+def refresh():
+    """
+    Reload reference tables after they change,
+    and have other workers reload them on their next sync
+    """
+    with db.session_scope() as session:
+        if not Property.increment(session, VERSION_PROPERTY):
+            session.add(Property(None, VERSION_PROPERTY, '1'))
+    load()
+
+
+def _tables(model: type) -> Tuple[Dict[int, Any], Dict[str, Any]]:
+    if not __entries:
+        load()
+    return __entries[model]
+
+
+def _reload() -> bool:
+    """
+    Reload after a lookup miss, unless loaded in the last MISS_RELOAD seconds
+    :return: True if reloaded
+    """
+    if time.monotonic() - __loaded < MISS_RELOAD:
+        return False
+    logging.info('reference data miss, reloading')
+    load()
+    return True
+
+
+def get(model: type, id: int) -> Optional[Any]:
+    """
+    Entry by id
+    :param model: reference table (see TABLES)
+    :return: entry, or None if not found
+    """
+    entry = _tables(model)[0].get(id)
+    if entry is None and _reload():
+        entry = _tables(model)[0].get(id)
+    return entry
+
+
+def get_by_name(model: type, name: str) -> Optional[Any]:
+    """
+    Entry by name
+    :param model: reference table (see TABLES)
+    :return: entry, or None if not found
+    """
+    entry = _tables(model)[1].get(name)
+    if entry is None and _reload():
+        entry = _tables(model)[1].get(name)
+    return entry
+
+
+def get_all(model: type, ids: Iterable[int]=None) -> List[Any]:
+    """
+    Entries by id, in order
+    Ids still missing after a reload are skipped
+    :param model: reference table (see TABLES)
+    :param ids: entry ids (default: all entries)
+    """
+    by_id = _tables(model)[0]
+    if ids is None:
+        return sorted(by_id.values(), key=lambda entry: entry.id)
+    ids = list(ids)
+    if any(id not in by_id for id in ids) and _reload():
+        by_id = _tables(model)[0]
+    entries = []
+    for id in ids:
+        entry = by_id.get(id)
+        if entry is None:
+            logging.warning(f'{model.__name__} {id} not in reference data')
+        else:
+            entries.append(entry)
+    return entries
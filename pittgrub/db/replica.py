@@ -0,0 +1,47 @@
+"""
+Read-your-writes pinning for read replicas
+After a user writes, their reads stay on the primary until replicas catch up
+"""
+
+import mmap
+import multiprocessing
+import struct
+import time
+
+
+# pin slot: expiry (monotonic seconds)
+_SLOT = struct.Struct('=d')
+
+
+class PinTable:
+    """
+    Users pinned to the primary, shared between processes
+    Must be created before the server forks
+    Users whose ids share a slot share its pin, so a collision can only
+    send extra reads to the primary, never a pinned user's to a replica
+    """
+
+    def __init__(self, window: float, slots: int=65536):
+        """
+        :param window: seconds a user stays pinned after writing
+        :param slots: number of pin slots (default: 65536)
+        """
+        assert slots > 0, 'At least one pin slot required'
+        self.window = window
+        self.slots = slots
+        self._mem = mmap.mmap(-1, slots * _SLOT.size)
+        self._lock = multiprocessing.Lock()
+
+    def pin(self, user_id: int):
+        """Pin user's reads to the primary for the window"""
+        offset = (user_id % self.slots) * _SLOT.size
+        expires = time.monotonic() + self.window
+        with self._lock:
+            if _SLOT.unpack_from(self._mem, offset)[0] < expires:
+                _SLOT.pack_into(self._mem, offset, expires)
+
+    def is_pinned(self, user_id: int) -> bool:
+        offset = (user_id % self.slots) * _SLOT.size
+        with self._lock:
+            expires = _SLOT.unpack_from(self._mem, offset)[0]
+        return expires > time.monotonic()
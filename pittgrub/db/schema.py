@@ -3,23 +3,29 @@ import random
 import secrets
 import string
 from decimal import Decimal
-from typing import Any, Dict, List, Optional, Tuple, Union
+from typing import Any, Dict, List, Optional, Sequence, Tuple, Union
 
 from passlib.hash import bcrypt_sha256
-from sqlalchemy import Column, ForeignKey, desc, func
+from sqlalchemy import Column, ForeignKey, Index, and_, cast, exists, func, select
+from sqlalchemy.dialects import mysql
 from sqlalchemy.ext.associationproxy import association_proxy
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy.orm import backref, relationship, validates
-from sqlalchemy.types import (BIGINT, BOOLEAN, CHAR, DECIMAL, INT, SMALLINT,
-                              VARCHAR, DateTime, Enum, TEXT)
+from sqlalchemy.types import (BIGINT, BOOLEAN, CHAR, DECIMAL, INT, INTEGER,
+                              SMALLINT, VARCHAR, Date, DateTime, Enum, TEXT)
 
 import db
-from db.base import (Activity, Entity, OrganizationRole, Password,
-                     ReferralStatus, UserStatus)
+from db.base import (Activity, Entity, OrganizationRole, Page, Password,
+                     ReferralStatus, UserStatus, encode_cursor, keyset_filter,
+                     paginate)
 
 # database db.session variables
 Base = declarative_base()
 
+# SQLite only autoincrements INTEGER primary keys
+BIGINT = BIGINT().with_variant(INTEGER(), 'sqlite')
+SMALLINT = SMALLINT().with_variant(INTEGER(), 'sqlite')
+
 
 class EmailList(Base, Entity):
     __tablename__ = 'EmailList'
@@ -46,6 +52,10 @@ class EmailList(Base, Entity):
 
 class User(Base, Entity):
     __tablename__ = 'User'
+    __table_args__ = (
+        # next_users_to_permit
+        Index('ix_User_status_id', 'status', 'id'),
+    )
 
     id = Column('id', BIGINT, primary_key=True, autoincrement=True)
     created = Column('created', DateTime, nullable=False, default=datetime.datetime.utcnow)
@@ -64,14 +74,21 @@ class User(Base, Entity):
 
 
     # mappings
-    roles = association_proxy('_user_roles', 'role')
     expo_tokens = association_proxy('_user_expo_tokens', 'token')
-    food_preferences = association_proxy('_user_foodpreferences', 'food_preference')
     recommended_events = association_proxy('_user_recommended_events', 'event')
     accepted_events = association_proxy('_user_accepted_events', 'event')
     checkedin_events = association_proxy('_user_checkedin_events', 'event')
     affiliation = relationship("PrimaryAffiliation", foreign_keys=[primary_affiliation])
 
+    # reference data, from memory (see db.reference)
+    @property
+    def roles(self) -> List[Any]:
+        return db.reference.get_all(Role, [user_role.role_id for user_role in self._user_roles])
+
+    @property
+    def food_preferences(self) -> List[Any]:
+        return db.reference.get_all(FoodPreference, [pref.foodpref_id for pref in self._user_foodpreferences])
+
 
     def __init__(
             self,
@@ -140,12 +157,9 @@ class User(Base, Entity):
         if User.get_by_email(session, user.email) is not None:
             return None
         session.add(user)
-        session.commit()
-        session.refresh(user)
-        session.add(UserRole(user.id, Role.get_by_name(session, 'User').id))
-        if roles is not None:
-            for role in roles:
-                session.add(UserRole(user.id, role.id))
+        session.flush()
+        role_ids = [db.reference.get_by_name(Role, 'User').id] + [role.id for role in roles or []]
+        UserRole.bulk_upsert(session, [dict(user_id=user.id, role_id=role_id) for role_id in role_ids])
         return user
 
     @classmethod
@@ -155,9 +169,15 @@ class User(Base, Entity):
             return False
         return bcrypt_sha256.verify(password, user.password)
 
+    @classmethod
+    def get_disabled_ids(cls, session) -> List[int]:
+        return [id for id, in session.query(cls.id).filter(cls.disabled.is_(True))]
+
     @classmethod
     def next_users_to_permit(cls, session) -> List['User']:
-        limit = int(Property.get_by_name(session, 'user.threshold').value)
+        # no slots until the threshold is set
+        threshold = Property.get_by_name(session, 'user.threshold')
+        limit = int(threshold.value) if threshold is not None else 0
         return session.query(cls)\
             .filter(cls.status == UserStatus.REQUESTED)\
             .order_by(cls.id.asc())\
@@ -170,7 +190,11 @@ class User(Base, Entity):
 
 class UserActivity(Base):
     __tablename__ = 'UserActivity'
-    
+    __table_args__ = (
+        # activity by user over time
+        Index('ix_UserActivity_user_id_time', 'user_id', 'time'),
+    )
+
     id = Column('id', BIGINT, primary_key=True, autoincrement=True)
     user_id = Column('user_id', BIGINT, ForeignKey('User.id'))
     activity = Column('activity', Enum(Activity), nullable=False)
@@ -183,6 +207,79 @@ class UserActivity(Base):
         self.activity = activity
         self.time = datetime.datetime.utcnow()
 
+    @classmethod
+    def get_by_user(cls, session, user_id: int, since: datetime.datetime=None) -> List['UserActivity']:
+        """User's activity, most recent first"""
+        query = session.query(cls).filter(cls.user_id == user_id)
+        if since is not None:
+            query = query.filter(cls.time >= since)
+        return query.order_by(cls.time.desc()).all()
+
+
+class UserActivityDaily(Base):
+    """
+    UserActivity rolled up by the retention job, per user and activity
+    Activity without a user is summed in rows with no user_id
+    """
+    __tablename__ = 'UserActivityDaily'
+    __table_args__ = (
+        Index('ix_UserActivityDaily_day_user_id_activity', 'day', 'user_id', 'activity', unique=True),
+    )
+
+    id = Column('id', BIGINT, primary_key=True, autoincrement=True)
+    day = Column('day', Date, nullable=False)
+    user_id = Column('user_id', BIGINT, ForeignKey('User.id'), nullable=True)
+    activity = Column('activity', Enum(Activity), nullable=False)
+    count = Column('count', INT, nullable=False)
+
+
+class TokenRevocation(Base, Entity):
+    """
+    Tokens issued to a user before time are revoked
+    Added on logout; disabled users are refused separately (see User.get_disabled_ids)
+    """
+    __tablename__ = 'TokenRevocation'
+    __table_args__ = (
+        # get_latest_by_user
+        Index('ix_TokenRevocation_user_id_time', 'user_id', 'time'),
+        # get_since
+        Index('ix_TokenRevocation_time', 'time'),
+    )
+
+    id = Column('id', BIGINT, primary_key=True, autoincrement=True)
+    user_id = Column('user_id', BIGINT, ForeignKey('User.id'), nullable=False)
+    time = Column('time', DateTime().with_variant(mysql.DATETIME(fsp=3), 'mysql'), nullable=False,
+                  default=datetime.datetime.utcnow)
+
+    def __init__(self, user_id: int=None, time: datetime=None):
+        self.user_id = user_id
+        # milliseconds, matching token issue times
+        time = time or datetime.datetime.utcnow()
+        self.time = time.replace(microsecond=time.microsecond // 1000 * 1000)
+
+    @classmethod
+    def get_latest_by_user(cls, session) -> List[Tuple[int, datetime.datetime]]:
+        """Most recent revocation time for each user"""
+        return session.query(cls.user_id, func.max(cls.time))\
+            .group_by(cls.user_id)\
+            .all()
+
+    @classmethod
+    def get_since(cls, session, since: datetime.datetime=None) -> List[Tuple[int, datetime.datetime]]:
+        """
+        (user id, time) of revocations at or after since, oldest first
+        :param since: earliest revocation time (default: all revocations)
+        """
+        query = session.query(cls.user_id, cls.time)
+        if since is not None:
+            query = query.filter(cls.time >= since)
+        return query.order_by(cls.time.asc()).all()
+
+    @classmethod
+    def last_time(cls, session) -> Optional[datetime.datetime]:
+        """Time of the latest revocation, or None if there are none"""
+        return session.query(func.max(cls.time)).scalar()
+
 
 class PrimaryAffiliation(Base, Entity):
     """
@@ -223,7 +320,7 @@ class Role(Base, Entity):
         return session.query(cls).filter_by(name=name).one_or_none()
 
 
-class UserRole(Base):
+class UserRole(Base, Entity):
     """
     User role relationship
     """
@@ -241,9 +338,8 @@ class UserRole(Base):
 
     @classmethod
     def create_host(cls, session, user_id: int):
-        role = Role.get_by_name(session, 'Host')
-        user_role = UserRole(user_id, role.id)
-        session.add(user_role)
+        role = db.reference.get_by_name(Role, 'Host')
+        cls.bulk_upsert(session, [dict(user_id=user_id, role_id=role.id)])
 
 
 # TODO: complete organization
@@ -318,15 +414,38 @@ class UserLocation(Base):
         self.longitude = long
 
     @classmethod
-    def most_recent_for_user(cls, session, id: int) -> 'UserLocation':
-        return session.query(UserLocation)\
-            .filter_by(user_id=id)\
-            .order_by(desc('time'))\
-            .first()
+    def most_recent_for_user(cls, session, id: int, within: datetime.timedelta=datetime.timedelta(days=1)) -> Optional['UserLocation']:
+        """
+        User's latest location
+        Looks within the recent window first, so a table partitioned by time
+        only searches its newest partitions for active users
+        """
+        query = session.query(cls)\
+            .filter(cls.user_id == id)\
+            .order_by(cls.time.desc())
+        recent = query.filter(cls.time >= datetime.datetime.utcnow() - within).first()
+        return recent if recent is not None else query.first()
+
+
+class UserLocationDaily(Base):
+    """UserLocation rolled up by the retention job, per user: ping count, time span and mean position"""
+    __tablename__ = 'UserLocationDaily'
+
+    day = Column('day', Date, primary_key=True)
+    user_id = Column('user_id', BIGINT, ForeignKey('User.id'), primary_key=True)
+    pings = Column('pings', INT, nullable=False)
+    first = Column('first', DateTime, nullable=False)
+    last = Column('last', DateTime, nullable=False)
+    latitude = Column('latitude', DECIMAL(10, 8), nullable=False)
+    longitude = Column('longitude', DECIMAL(11, 8), nullable=False)
 
 
 class UserHostRequest(Base, Entity):
     __tablename__ = 'UserHostRequest'
+    __table_args__ = (
+        # get_pending_page
+        Index('ix_UserHostRequest_approved', 'approved'),
+    )
 
     id = Column('id', BIGINT, primary_key=True, autoincrement=True)
     user_id = Column('user', BIGINT, ForeignKey("User.id"), unique=True, nullable=False)
@@ -353,8 +472,10 @@ class UserHostRequest(Base, Entity):
         return session.query(cls).filter_by(user_id=user_id).one_or_none()
 
     @classmethod
-    def get_all_pending(cls, session):
-        return session.query(cls).filter(cls.approved.is_(None)).all()
+    def get_pending_page(cls, session, limit: int, cursor: str=None, options: Sequence=()) -> Page:
+        """Page of requests awaiting approval, oldest first"""
+        query = session.query(cls).options(*options).filter(cls.approved.is_(None))
+        return paginate(query, (cls.id,), limit, cursor)
 
 
 class UserReferral(Base):
@@ -475,7 +596,7 @@ class FoodPreference(Base, Entity):
         self.description = description
 
 
-class UserFoodPreference(Base):
+class UserFoodPreference(Base, Entity):
     __tablename__ = 'UserFoodPreference'
 
     user_id = Column('user_id', BIGINT, ForeignKey('User.id'), primary_key=True)
@@ -489,18 +610,9 @@ class UserFoodPreference(Base):
         self.foodpref_id = foodpreference
 
     @classmethod
-    def add(cls, session, user_id: int, foodpreference: Union[int, List[int]]) -> Union['UserFoodPreference', List['UserFoodPreference']]:
-        if isinstance(foodpreference, list):
-            user_foodpreferences = []
-            for fp in foodpreference:
-                user_foodpreference = UserFoodPreference(user_id, fp)
-                session.add(user_foodpreference)
-                user_foodpreferences.append(user_foodpreference)
-        else:
-            user_foodpreferences = UserFoodPreference(user_id, foodpreference)
-            session.add(user_foodpreferences)
-        session.commit()
-        return user_foodpreferences
+    def add(cls, session, user_id: int, foodpreference: Union[int, List[int]]):
+        foodpreferences = foodpreference if isinstance(foodpreference, list) else [foodpreference]
+        cls.bulk_upsert(session, [dict(user_id=user_id, foodpref_id=fp) for fp in foodpreferences])
 
     @classmethod
     def update(cls, session, user_id: int, foodpreferences: Union[int, List[int]]):
@@ -508,8 +620,8 @@ class UserFoodPreference(Base):
         cls.add(session, user_id, foodpreferences)
 
     @classmethod
-    def delete(cls, session, user_id: int):
-        session.query(cls).filter_by(user_id=user_id).delete()
+    def delete(cls, session, user_id: int) -> int:
+        return cls.bulk_delete(session, cls.user_id == user_id)
 
 
 class UserVerification(Base):
@@ -518,7 +630,7 @@ class UserVerification(Base):
     code = Column('code', CHAR(6), primary_key=True)
     user_id = Column('user_id', BIGINT, ForeignKey('User.id'), unique=True, nullable=False)
 
-    user = relationship(User)
+    user = relationship(User, backref=backref('_verification', uselist=False))
 
     def __init__(self, code: str, user_id: int):
         self.code = code
@@ -530,8 +642,7 @@ class UserVerification(Base):
         code = code or cls.generate_code()
         verification = UserVerification(code, user_id)
         session.add(verification)
-        session.commit()
-        session.refresh(verification)
+        session.flush()
         return verification
 
     @classmethod
@@ -560,6 +671,10 @@ class UserVerification(Base):
 
 class Event(Base, Entity):
     __tablename__ = 'Event'
+    __table_args__ = (
+        # get_all_active
+        Index('ix_Event_end_date_start_date', 'end_date', 'start_date'),
+    )
 
     id = Column('id', BIGINT, primary_key=True, autoincrement=True)
     created = Column('created', DateTime, nullable=False, default=datetime.datetime.utcnow)
@@ -576,13 +691,17 @@ class Event(Base, Entity):
     longitude = Column('longitude', DECIMAL(11, 8), nullable=True)
 
     # mappings
-    food_preferences = association_proxy('_event_foodpreferences', 'food_preference')
     recommended_users = association_proxy('_event_recommended_users', 'user')
     accepted_users = association_proxy('_event_accepted_users', 'user')
     checkin_users = association_proxy('_event_checkedin_users', 'user')
 
     organizer = relationship("User", foreign_keys=[organizer_id])
 
+    # reference data, from memory (see db.reference)
+    @property
+    def food_preferences(self) -> List[Any]:
+        return db.reference.get_all(FoodPreference, [pref.foodpref_id for pref in self._event_foodpreferences])
+
     def __init__(
             self,
             id: int=None,
@@ -626,28 +745,88 @@ class Event(Base, Entity):
             .one_or_none()
 
     @classmethod
-    def get_all_active(cls, session) -> List['Event']:
+    def get_all_active(cls, session, options: Sequence=()) -> List['Event']:
         entities = session.query(cls)\
+            .options(*options)\
             .filter(cls.end_date > datetime.datetime.now())\
             .order_by(cls.start_date)\
             .all()
         return entities
 
     @classmethod
-    def get_all_active_by_user(cls, session, user_id: int) -> List[Tuple['Event', int, int]]:
-        accept_subquery = session.query(func.count())\
-            .filter(UserAcceptedEvent.user_id == user_id)\
-            .filter(UserAcceptedEvent.event_id == Event.id)
-        rec_subquery = session.query(func.count())\
-            .filter(UserRecommendedEvent.user_id == User.id)\
-            .filter(UserRecommendedEvent.event_id == Event.id)
-        return session.query(
-                cls,
-                accept_subquery.label('accepted'),
-                rec_subquery.label('recommended'))\
-            .filter(cls.end_date > datetime.datetime.utcnow())\
-            .order_by(cls.start_date)\
+    def get_all_active_by_user(cls, session, user_id: int, limit: int, cursor: str=None) -> Page:
+        """
+        Page of active events for user's feed, in one statement
+        Accepted and recommended are looked up per event, so the cost
+        doesn't grow with the user's history
+        :return: page of rows of event columns, accepted, recommended, organizer_name,
+                 organizer_affiliation_id, image_url and one food_preference_id
+                 (None if event has none), one row per event and food preference,
+                 ordered by start date (names of reference data are in db.reference)
+        """
+        order = (cls.start_date, cls.id)
+        # the page's events, plus one to tell if there is a next page
+        # (a derived table, since MySQL doesn't allow LIMIT in IN subqueries)
+        events = session.query(cls.id.label('id'))\
+            .filter(cls.end_date > datetime.datetime.now())
+        if cursor is not None:
+            events = events.filter(keyset_filter(order, cursor))
+        events = events.order_by(*order).limit(limit + 1).subquery()
+        accepted = exists().where(and_(
+            UserAcceptedEvent.user_id == user_id,
+            UserAcceptedEvent.event_id == cls.id))
+        recommended = exists().where(and_(
+            UserRecommendedEvent.user_id == user_id,
+            UserRecommendedEvent.event_id == cls.id))
+        image_url = select([EventImage.url])\
+            .where(EventImage.event_id == cls.id)\
+            .limit(1)\
+            .as_scalar()
+        rows = session.query(
+                *cls.__table__.columns,
+                accepted.label('accepted'),
+                recommended.label('recommended'),
+                User.name.label('organizer_name'),
+                User.primary_affiliation.label('organizer_affiliation_id'),
+                image_url.label('image_url'),
+                EventFoodPreference.foodpref_id.label('food_preference_id'))\
+            .join(events, events.c.id == cls.id)\
+            .join(User, User.id == cls.organizer_id)\
+            .outerjoin(EventFoodPreference, EventFoodPreference.event_id == cls.id)\
+            .order_by(*order)\
             .all()
+        ids = list(dict.fromkeys(row.id for row in rows))
+        if len(ids) <= limit:
+            return Page(rows, None)
+        rows = [row for row in rows if row.id != ids[limit]]
+        return Page(rows, encode_cursor((rows[-1].start_date, rows[-1].id)))
+
+    @classmethod
+    def get_accepted_by_user(cls, session, user_id: int, limit: int, cursor: str=None, options: Sequence=()) -> Page:
+        """Page of events user accepted, by start date"""
+        query = session.query(cls)\
+            .options(*options)\
+            .join(UserAcceptedEvent, UserAcceptedEvent.event_id == cls.id)\
+            .filter(UserAcceptedEvent.user_id == user_id)
+        return paginate(query, (cls.start_date, cls.id), limit, cursor)
+
+    @classmethod
+    def get_recommended_by_user(cls, session, user_id: int, limit: int, cursor: str=None, options: Sequence=(), valid: bool=False) -> Page:
+        """
+        Page of events recommended to user, by start date
+        :param valid: only active events user hasn't accepted (default: False)
+        """
+        query = session.query(cls)\
+            .options(*options)\
+            .join(UserRecommendedEvent, UserRecommendedEvent.event_id == cls.id)\
+            .filter(UserRecommendedEvent.user_id == user_id)
+        if valid:
+            query = query\
+                .filter(cls.end_date > datetime.datetime.now())\
+                .filter(~exists().where(and_(
+                    UserAcceptedEvent.user_id == user_id,
+                    UserAcceptedEvent.event_id == cls.id)))
+        return paginate(query, (cls.start_date, cls.id), limit, cursor)
 
     @validates('end_date')
     def validate_end_date(self, key: datetime, end_date: datetime) -> datetime:
@@ -655,7 +834,7 @@ class Event(Base, Entity):
         return end_date
 
 
-class EventFoodPreference(Base):
+class EventFoodPreference(Base, Entity):
     __tablename__ = 'EventFoodPreference'
 
     event_id = Column('event_id', BIGINT, ForeignKey('Event.id'), primary_key=True)
@@ -673,23 +852,9 @@ class EventFoodPreference(Base):
         return session.query(cls).get([event_id, foodpreference_id])
 
     @classmethod
-    def add(cls, session, event_id: int, foodpreference: Union[int, List[int]]) -> Union['EventFoodPreference', List['EventFoodPreference']]:
-
-        if isinstance(foodpreference, list):
-            event_foodpreferences = []
-            for fp in foodpreference:
-                event_foodpreference = EventFoodPreference.get_by_id(session, event_id, fp)
-                if not event_foodpreference:
-                    event_foodpreference = EventFoodPreference(event_id, fp)
-                    session.add(event_foodpreference)
-                event_foodpreferences.append(event_foodpreference)
-        else:
-            event_foodpreferences = EventFoodPreference.get_by_id(session, event_id, foodpreference)
-            if not event_foodpreferences:
-                event_foodpreferences = EventFoodPreference(event_id, foodpreference)
-                session.add(event_foodpreferences)
-        session.commit()
-        return event_foodpreferences
+    def add(cls, session, event_id: int, foodpreference: Union[int, List[int]]):
+        foodpreferences = foodpreference if isinstance(foodpreference, list) else [foodpreference]
+        cls.bulk_upsert(session, [dict(event_id=event_id, foodpref_id=fp) for fp in foodpreferences])
 
 
 """
@@ -723,7 +888,7 @@ Event types are not currently used
 #
 
 
-class UserRecommendedEvent(Base):
+class UserRecommendedEvent(Base, Entity):
     __tablename__ = 'UserRecommendedEvent'
 
     event_id = Column('event_id', BIGINT, ForeignKey('Event.id'), primary_key=True)
@@ -756,7 +921,7 @@ class UserRecommendedEvent(Base):
         return entities
 
 
-class UserAcceptedEvent(Base):
+class UserAcceptedEvent(Base, Entity):
     __tablename__ = 'UserAcceptedEvent'
 
     event_id = Column('event_id', BIGINT, ForeignKey('Event.id'), primary_key=True)
@@ -815,6 +980,10 @@ class UserCheckedInEvent(Base):
 
 class EventImage(Base, Entity):
     __tablename__ = "EventImage"
+    __table_args__ = (
+        # image url in Event.get_all_active_by_user
+        Index('ix_EventImage_event', 'event'),
+    )
 
     id = Column('id', BIGINT, primary_key=True, autoincrement=True)
     event_id = Column('event', BIGINT, ForeignKey('Event.id'), unique=False)
@@ -890,3 +1059,38 @@ class Property(Base, Entity):
     @classmethod
     def get_cacheable(cls, session) -> List['Property']:
         return session.query(cls).filter_by(cached=True).all()
+
+    @classmethod
+    def reserve(cls, session, name: str, n: int=1, partial: bool=False) -> int:
+        """
+        Take n from a counter property in one conditional UPDATE,
+        so concurrent reservations never take more than it holds
+        :param session: database session
+        :param name:    property name
+        :param n:       number to take
+        :param partial: take what is left when less than n (default: all or nothing)
+        :return:        number taken
+        """
+        count = cast(cls.value, INTEGER)
+        while n > 0:
+            taken = session.query(cls)\
+                .filter(cls.name == name, count >= n)\
+                .update({cls.value: count - n, cls.updated: datetime.datetime.utcnow()}, synchronize_session=False)
+            if taken:
+                return n
+            if not partial:
+                return 0
+            # fewer left than asked for, try again with what is left
+            n = min(n, session.query(count).filter(cls.name == name).scalar() or 0)
+        return 0
+
+    @classmethod
+    def increment(cls, session, name: str, n: int=1) -> bool:
+        """
+        Add n to a counter property in one UPDATE
+        :return: False if there is no such property
+        """
+        return bool(session.query(cls)
+                    .filter(cls.name == name)
+                    .update({cls.value: cast(cls.value, INTEGER) + n, cls.updated: datetime.datetime.utcnow()},
+                            synchronize_session=False))
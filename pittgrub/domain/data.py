@@ -4,10 +4,13 @@ Author: Mark Silvis
 """
 
 from abc import ABC
+from itertools import groupby
 import logging
-from typing import Any, Dict, List, Type, TypeVar
+from types import SimpleNamespace
+from typing import Any, Dict, List, Sequence, Type, TypeVar
 
-from db.schema import Base
+from db import reference
+from db.schema import Base, FoodPreference, PrimaryAffiliation
 
 D = TypeVar('Data', bound='Data')
 
@@ -74,6 +77,28 @@ class EventViewData(Data):
         self.recommended = bool(recommended)
         self.image_url = image_url
 
+    @classmethod
+    def from_rows(cls, rows: Sequence[Any]) -> List['EventViewData']:
+        """
+        Views from Event.get_all_active_by_user rows,
+        which repeat each event once per food preference
+        """
+        views = []
+        for _, event_rows in groupby(rows, key=lambda row: row.id):
+            event_rows = list(event_rows)
+            row = event_rows[0]
+            organizer = SimpleNamespace(
+                name=row.organizer_name,
+                affiliation=reference.get(PrimaryAffiliation, row.organizer_affiliation_id) or SimpleNamespace(name=None))
+            food_preferences = reference.get_all(
+                FoodPreference, [r.food_preference_id for r in event_rows if r.food_preference_id is not None])
+            fields = row._asdict()
+            # the organizer column holds the organizer's id
+            fields.update(organizer_id=row.organizer, organizer=organizer, food_preferences=food_preferences)
+            event = SimpleNamespace(**fields)
+            views.append(cls(event, row.accepted, row.recommended, row.image_url))
+        return views
+
     def json(self) -> Dict[str, Any]:
         data = self.__dict__
         data['food_preferences'] = [{'id': f.id, 'name': f.name} for f in self.food_preferences]
@@ -99,6 +124,11 @@ class UserData(Data):
         self.active = user.active
         self.disabled = user.disabled
 
+    @property
+    def role_names(self) -> List[str]:
+        """Names of user's roles, for minting tokens (read before json())"""
+        return [role.name for role in self.roles]
+
     def json(self) -> Dict[str, Any]:
         data = self.__dict__
         data['roles'] = [{'id': r.id, 'name': r.name} for r in self.roles]
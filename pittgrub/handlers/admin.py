@@ -13,34 +13,35 @@ from handlers.base import CORSHandler, SecureHandler
 from handlers.response import Payload
 from service import MissingUserError
 from service.admin import (
-    host_approval, get_pending_host_requests, AdminPermissionError, get_referrals
+    host_approval, get_pending_host_requests, AdminPermissionError, get_referrals, refresh_reference_data
 )
-from service.property import get_property, set_property
+from service.property import increment_property
 from service.user import invite_next_users
 
 
 class HostApprovalHandler(CORSHandler, SecureHandler):
     required_fields = {'user_id'}
 
-    def get(self, path: str):
-        if not self.has_admin_role():
-            logging.warning(f'User {self.get_user_id()} attempted to approve host')
+    async def get(self, path: str):
+        if not self.auth.is_admin:
+            logging.warning(f'User {self.auth.owner} attempted to approve host')
             self.write_error(403, 'Error: insufficient permissions')
         else:
-            host_requests = get_pending_host_requests()
-            self.success(200, payload=Payload(host_requests))
+            payload = await self.run_page(get_pending_host_requests)
+            if payload is not None:
+                self.success(200, payload=payload)
 
-    def post(self, path: str):
+    async def post(self, path: str):
         data = self.get_data()
         user_id = data.get('user_id')
         if not isinstance(user_id, int):
             self.write_error(400, 'Error: invalid user id')
-        elif not self.has_admin_role():
+        elif not self.auth.is_admin:
             self.write_error(403, 'Error: insufficient permissions')
         else:
-            admin_id = self.get_user_id()
+            admin_id = self.auth.owner
             try:
-                if not host_approval(data['user_id'], admin_id):
+                if not await self.run_db(host_approval, data['user_id'], admin_id):
                     self.write_error(400, 'Error: incorrect user id')
                 else:
                     self.set_status(204)
@@ -51,15 +52,26 @@ class HostApprovalHandler(CORSHandler, SecureHandler):
         self.finish()
 
 
+class ReferenceDataHandler(SecureHandler):
+
+    async def post(self, path: str):
+        if not self.auth.is_admin:
+            self.write_error(403, 'Error: insufficient permissions')
+        else:
+            await self.run_db(refresh_reference_data)
+            self.set_status(204)
+        self.finish()
+
+
 class UserReferralHandler(CORSHandler, SecureHandler):
     def get(self, path: str):
-        user_id = self.get_user_id()
+        user_id = self.auth.owner
         refs = get_referrals(user_id)
         self.success(status=200, payload=Payload(refs))
 
     def post(self, path: str):
         keys = ['user', 'approve']
-        user_id = self.get_user_id()
+        user_id = self.auth.owner
 
         # decode json
         data = json_decode(self.request.body)
@@ -84,14 +96,14 @@ class UserReferralHandler(CORSHandler, SecureHandler):
 
 class UserPendingReferralHandler(CORSHandler, SecureHandler):
     def get(self, path: str):
-        user_id = self.get_user_id()
+        user_id = self.auth.owner
         refs = UserReferral.get_pending(user_id)
         self.success(status=200, payload=Payload(refs))
 
 class UserApprovedReferralHandler(CORSHandler, SecureHandler):
     def get(self, path: str):
         print(f'path: {path}')
-        user_id = self.get_user_id()
+        user_id = self.auth.owner
         print(f'referrals for: {user_id}')
         refs = UserReferral.get_approved(user_id)
         print(f'approved referrals: {refs}')
@@ -100,8 +112,8 @@ class UserApprovedReferralHandler(CORSHandler, SecureHandler):
 class UpdateUserThreshold(SecureHandler):
     required_fields = set(['increment'])
     
-    def post(self, path):
-        if not self.has_admin_role():
+    async def post(self, path):
+        if not self.auth.is_admin:
             self.write_error(403)
             raise Finish()
 
@@ -114,8 +126,8 @@ class UpdateUserThreshold(SecureHandler):
             self.write_error(400, f"Error: invalid number")
             raise Finish()
 
-        set_property(prop, str(int(get_property(prop)) + increment))
-        invite_next_users()
+        await self.run_db(increment_property, prop, increment)
+        await self.run_db(invite_next_users)
         self.success(status=201)
         self.finish()
 
@@ -1,30 +1,72 @@
+import functools
 import logging
+import math
 import re
 from typing import (
+    Any,
+    Callable,
     Dict,
-    List,
+    FrozenSet,
     Optional,
-    TypeVar,
-    Union
+    TypeVar
 )
 
-from jwt import DecodeError, ExpiredSignatureError, get_unverified_header
+from jwt import DecodeError, ExpiredSignatureError
 from tornado import web
 from tornado.escape import json_decode, utf8
+from tornado.ioloop import IOLoop
+from tornado.log import access_log
 from tornado.util import unicode_type
 from tornado.web import Finish
 
+from db import InvalidCursor, querystats
 from handlers.response import Payload, ErrorResponse
 from service.auth import JwtTokenService
+from service.revocation import is_disabled, is_revoked
 from util import json_esc
 
 # typing
 Writable = TypeVar('Writable', bytes, unicode_type, Dict, Payload, object)
 
+# list endpoint page sizes, set with the limit argument
+PAGE_SIZE = 50
+MAX_PAGE_SIZE = 200
+
+
+def log_request(handler: web.RequestHandler):
+    """
+    Access log line with the request's database statistics
+    Flags requests running more queries or spending more database time
+    than the slow_query_count and slow_query_ms settings allow
+    """
+    status = handler.get_status()
+    if status < 400:
+        log_method = access_log.info
+    elif status < 500:
+        log_method = access_log.warning
+    else:
+        log_method = access_log.error
+    request_time = 1000.0 * handler.request.request_time()
+    stats = getattr(handler, 'query_stats', None)
+    if stats is None:
+        log_method('%d %s %.2fms', status, handler._request_summary(), request_time)
+        return
+    log_method('%d %s %.2fms (%s)', status, handler._request_summary(), request_time, stats)
+    max_count = handler.settings.get('slow_query_count', 0)
+    max_time = handler.settings.get('slow_query_ms', 0)
+    if (max_count and stats.count > max_count) or (max_time and 1000 * stats.time > max_time):
+        access_log.warning('slow database work: %s %s, slowest %.2fms: %s',
+                           handler._request_summary(), stats, 1000 * stats.slowest_time, ' '.join(stats.slowest.split()))
+
 
 class BaseHandler(web.RequestHandler):
     """Common handler"""
 
+    def __init__(self, *args, **kwargs):
+        # statements run by this request's run_db calls
+        self.query_stats = querystats.QueryStats()
+        super().__init__(*args, **kwargs)
+
     def _check_https(self):
         """
         Verify HTTPS and redirect if not secure
@@ -47,6 +89,41 @@ class BaseHandler(web.RequestHandler):
             return dict()
         return json_decode(self.request.body)
 
+    async def run_db(self, fn: Callable[..., Any], *args, **kwargs) -> Any:
+        """
+        Run blocking database work on the DB executor,
+        keeping queries off the IOLoop
+        Its statements are counted in the request's query_stats
+        fn: function to call (typically a service function)
+        args, kwargs: arguments for fn
+        """
+        executor = self.settings.get('db_executor')
+        return await IOLoop.current().run_in_executor(
+            executor, functools.partial(querystats.run, self.query_stats, fn, *args, **kwargs))
+
+    async def run_page(self, fn: Callable[..., Any], *args) -> Optional[Payload]:
+        """
+        Run a paged service function (returning a Page) on the DB executor
+        with the request's limit and cursor arguments
+        fn: function to call, as fn(*args, limit, cursor)
+        args: arguments for fn
+        :return: payload of the page with a next link,
+                 or None after writing an error for invalid arguments
+        """
+        limit = self.get_query_argument('limit', str(PAGE_SIZE))
+        if not limit.isdecimal() or not 0 < int(limit) <= MAX_PAGE_SIZE:
+            self.write_error(400, f'Error: limit must be between 1 and {MAX_PAGE_SIZE}')
+            return None
+        cursor = self.get_query_argument('cursor', None)
+        try:
+            page = await self.run_db(fn, *args, int(limit), cursor)
+        except InvalidCursor:
+            self.write_error(400, 'Error: invalid cursor')
+            return None
+        payload = Payload(page.items)
+        payload.add_next_link(self.request.uri, page.next)
+        return payload
+
     def prepare(self):
         super().prepare()        
         self._check_https()
@@ -113,6 +190,80 @@ class CORSHandler(BaseHandler):
         self.finish()
 
 
+class RateLimitMixin:
+    """
+    Token bucket rate limiting for handler
+    Limits each client address by the '<rate_limit>_ip' budget, and each
+    user (or email in request body) by the '<rate_limit>' budget
+    Budgets are read from the RATELIMIT config section
+    """
+    rate_limit = None               # budget name
+    rate_limit_methods = ('POST',)  # methods limited
+
+    def rate_limit_key(self) -> Optional[str]:
+        """Identity limited in addition to client address"""
+        auth = getattr(self, 'auth', None)
+        if auth is not None:
+            return f'user:{auth.owner}'
+        try:
+            email = self.get_data().get('email')
+        except (ValueError, AttributeError):
+            return None
+        if isinstance(email, str) and email:
+            return f'email:{email.strip().lower()}'
+        return None
+
+    def _check_rate_limit(self):
+        limiter = self.settings.get('rate_limiter')
+        if limiter is None or self.rate_limit is None or self.request.method not in self.rate_limit_methods:
+            return
+        wait = limiter.consume([
+            (f'{self.rate_limit}_ip', self.request.remote_ip),
+            (self.rate_limit, self.rate_limit_key())])
+        if wait:
+            logging.warning(f'Rate limited {self.request.remote_ip} on {self.rate_limit}')
+            self.set_header('Retry-After', str(math.ceil(wait)))
+            self.write_error(429, 'Too many requests, try again later')
+            raise Finish()
+
+    def prepare(self):
+        super().prepare()
+        self._check_rate_limit()
+
+
+class AuthContext:
+    """
+    Authenticated owner of a request
+    Built once from the request's JWT so handlers don't decode it again
+    """
+    __slots__ = ('owner', 'roles', 'token_type', 'issued')
+
+    def __init__(self, owner: int, roles: FrozenSet[str], token_type: str, issued: float=0):
+        """
+        owner: user id
+        roles: role names
+        token_type: 'acc' for access token, 'ref' for refresh token
+        issued: token issue time (epoch seconds, to the millisecond)
+        """
+        self.owner = owner
+        self.roles = roles
+        self.token_type = token_type
+        self.issued = issued
+
+    @classmethod
+    def from_claims(cls, token_type: str, claims: Dict[str, Any]) -> 'AuthContext':
+        roles = frozenset(role for role in (claims.get('roles') or '').split(',') if role)
+        return cls(claims['own'], roles, token_type, claims.get('iat', 0))
+
+    @property
+    def is_host(self) -> bool:
+        return 'Host' in self.roles
+
+    @property
+    def is_admin(self) -> bool:
+        return 'Admin' in self.roles
+
+
 class SecureHandler(BaseHandler):
     """
     Secure resource handler
@@ -121,11 +272,14 @@ class SecureHandler(BaseHandler):
 
     def initialize(self, token_service: JwtTokenService):
         self.token_service = token_service
+        self.auth = None
 
     def _check_jwt(self):
         if self.request.method != 'OPTIONS':   # maybe not?
             try:
-                if not self.verify_jwt():
+                self.auth = self.get_auth()
+                if self.auth is None:
+                    self.write_error(401, 'Failed to read authorization token')
                     raise Finish()
             except ExpiredSignatureError:
                 self.write_error(401, 'Authorization token is expired')
@@ -133,6 +287,8 @@ class SecureHandler(BaseHandler):
             except DecodeError:
                 self.write_error(401, 'Invalid authorization token')
                 raise Finish()
+            except Finish:
+                raise
             except Exception as e:
                 self.write_error(401, 'Failed to read authorization token')
                 logging.warning('Failed to read authorization token\n', e)
@@ -140,64 +296,33 @@ class SecureHandler(BaseHandler):
         else:
             logging.info(f'OPTIONS headers: {self.request.headers}')
 
+    def _check_revoked(self):
+        if self.auth is not None:
+            if is_disabled(self.auth.owner):
+                self.write_error(403, 'Error: user account disabled')
+                raise Finish()
+            if is_revoked(self.auth.owner, self.auth.issued):
+                self.write_error(401, 'Authorization token has been revoked')
+                raise Finish()
+
     def prepare(self):
         super().prepare()
         self._check_jwt()
+        self._check_revoked()
 
-    def get_jwt(self, verify: bool=False) -> Optional[Dict[str, Union[int, str, 'datetime']]]:
+    def get_auth(self) -> Optional[AuthContext]:
         """
-        Retrieve decoded JSON web token
-        Note: verifying JWT will result in exception if expired
-        verify: verify JWT expiration (default: False)
-        :return: JWT dictionary if token provided
+        Decode and verify the request's JSON web token
+        Note: access tokens are verified for expiration
+        :return: auth context if token provided
             None if token not provided
         :raises: DecodeError if token fails to be decoded
-        :raises: ExpiredSignatureError: if verifying and token is expired
+        :raises: ExpiredSignatureError: if token is expired
         """
         auth = self.request.headers.get('Authorization')
         if auth is not None and auth.startswith('Bearer '):
             token = auth[7:]  # remove 'Bearer '
-            if get_unverified_header(token).get('tok') == 'acc':
-                return self.token_service.decode_access_token(token, verify)
-            elif get_unverified_header(token).get('tok') == 'ref':
-                return self.token_service.decode_refresh_token(token)
+            token_type, claims = self.token_service.decode_token(token, True)
+            if claims is not None:
+                return AuthContext.from_claims(token_type, claims)
         return None
-
-    def verify_jwt(self) -> Optional[bool]:
-        """Verify JWT is not expired
-        :return: True if not expired
-            False if expired
-        :raises ExpiredSignatureError: if token is expired
-        :raises DecodeError: if token fails to be decoded
-        """
-        return self.get_jwt(True) is not None
-
-    def get_user_id(self, verify: bool=False) -> int:
-        """
-        Get user id from JWT
-        return: user id
-        """
-        return self.get_jwt(verify)['own']
-
-    def get_roles(self) -> List[str]:
-        """
-        Get user roles from JWT
-        :return: list of roles
-        """
-        return self.get_jwt()['roles'].split(",")
-
-    def has_host_role(self) -> bool:
-        """
-        Check if JWT contains host role
-        :return: True if token contains 'Host' role
-            False if not
-        """
-        return 'Host' in self.get_roles()
-
-    def has_admin_role(self) -> bool:
-        """
-        Check if JWT contains admin role
-        :return: True if token contains 'Admin' role
-            False if not
-        """
-        return 'Admin' in self.get_roles()
@@ -34,6 +34,19 @@ from domain.data import UserData
 import logging
 
 
+def _recommend_event(event: 'EventData', rec_params: Dict[str, Any]=None):
+    """Recommend new event to users and notify them (runs in background executor)"""
+    send_push_to_users(
+        _event_recommendation(event, rec_params),
+        'PittGrub: New Event!',
+        event.title,
+        data={
+            'type': 'event',
+            'event': event.title,
+            'title':'PittGrub: New event!',
+            'body': event.title})
+
+
 class EventHandler(SecureHandler):
     required_fields = set(["title", "details", "start_date", "end_date", "address", "location", "servings", "food_preferences", "latitude", "longitude"])
 
@@ -42,7 +55,7 @@ class EventHandler(SecureHandler):
         self.executor = executor
         self.with_rec_params = rec_params
 
-    def get(self, path):
+    async def get(self, path):
         path = path.replace('/', '')
 
         if path:
@@ -50,7 +63,7 @@ class EventHandler(SecureHandler):
             if not (isinstance(path, int) or path.isdecimal()):
                 self.write_error(400, f'Error: Invalid event id')
             else:
-                value = get_event_by_user(int(path), self.get_user_id())
+                value = await self.run_db(get_event_by_user, int(path), self.auth.owner)
                 if value is None:
                     # event not found
                     self.write_error(404, f'Event not found with id: {path}')
@@ -61,13 +74,13 @@ class EventHandler(SecureHandler):
                     self.finish(payload)
         else:
             # get event list
-            value = get_active_by_user(self.get_user_id())
-            payload = Payload(value)
-            self.success(200, payload)
+            payload = await self.run_page(get_active_by_user, self.auth.owner)
+            if payload is not None:
+                self.success(200, payload)
             self.finish()
 
-    def post(self, path):
-        if not self.has_host_role():
+    async def post(self, path):
+        if not self.auth.is_host:
             self.write_error(400, 'Error: insufficient permissions')
         else:
             # decode json
@@ -77,27 +90,18 @@ class EventHandler(SecureHandler):
             data['start_date'] = data['start_date'].replace(tzinfo=None)
             data['end_date'] = dateutil.parser.parse(data['end_date'])
             data['end_date'] = data['end_date'].replace(tzinfo=None)
-            data['organizer'] = self.get_user_id()
+            data['organizer'] = self.auth.owner
             foodprefs = data.pop('food_preferences')
             data['image'] = data.get('image', False)
             # add event
-            event = create_event(**data)
+            event = await self.run_db(create_event, **data)
             if event:
                 # add food preferences
-                set_food_preferences(event.id, foodprefs)
+                await self.run_db(set_food_preferences, event.id, foodprefs)
                 payload = Payload(event)
                 self.success(201, payload)
-                # asynchronously send notification to recommend users
-                self.executor.submit(
-                    send_push_to_users,
-                    _event_recommendation(event,self.with_rec_params),
-                    'PittGrub: New Event!',
-                    event.title,
-                    data={
-                        'type': 'event',
-                        'event': event.title,
-                        'title':'PittGrub: New event!',
-                        'body': event.title})
+                # asynchronously recommend event to users and notify them
+                self.executor.submit(_recommend_event, event, self.with_rec_params)
             else:
                 self.set_status(400)
         self.finish()
@@ -105,38 +109,40 @@ class EventHandler(SecureHandler):
 
 class RecommendedEventHandler(SecureHandler):
 
-    def get(self, path):
-        user_id = self.get_user_id()
-        events = user_recommended_events_valid(user_id)
-        self.success(200, Payload(events))
+    async def get(self, path):
+        user_id = self.auth.owner
+        payload = await self.run_page(user_recommended_events_valid, user_id)
+        if payload is not None:
+            self.success(200, payload)
         self.finish()
 
 
 class AcceptedEventHandler(SecureHandler):
     required_fields = set(['event_id'])
 
-    def get(self, path):
+    async def get(self, path):
         # get data
-        user_id = self.get_user_id()
-        events = user_accepted_events(user_id)
-        self.success(200, Payload(events))
+        user_id = self.auth.owner
+        payload = await self.run_page(user_accepted_events, user_id)
+        if payload is not None:
+            self.success(200, payload)
         self.finish()
 
 
 class AcceptEventHandler(SecureHandler):
 
-    def post(self, path):
-        user_id = self.get_user_id()
+    async def post(self, path):
+        user_id = self.auth.owner
         event = self.get_data().get('event_id')
-        user_accept_event(event, user_id)
+        await self.run_db(user_accept_event, event, user_id)
         self.set_status(204)
         self.finish()
         logging.info(f'accepted event {event} for user {user_id}')
 
-    def delete(self, path):
-        user_id = self.get_user_id()
+    async def delete(self, path):
+        user_id = self.auth.owner
         event = self.get_data().get('event_id')
-        user_remove_event(event, user_id)
+        await self.run_db(user_remove_event, event, user_id)
         self.set_status(204)
         self.finish()
         logging.info(f'removed event {event} for user {user_id}')
@@ -161,8 +167,8 @@ class EventImageHandler(SecureHandler):
         super().initialize(token_service)
         self.image_store = image_store
 
-    def get(self, event_id, path):
-        event_image = get_event_image_by_event(event_id)
+    async def get(self, event_id, path):
+        event_image = await self.run_db(get_event_image_by_event, event_id)
         if event_image is None:
             self.write_error(404, f'Event image not found for event {event_id}')
         else:
@@ -178,11 +184,11 @@ class EventImageHandler(SecureHandler):
                 self.write(stream)
         self.finish()
 
-    def post(self, event_id, path):
-        event = get_event(event_id)
+    async def post(self, event_id, path):
+        event = await self.run_db(get_event, event_id)
         if event is None:
             self.write_error(404, f'Event not found with id: {id}')
-        elif not self.has_host_role() or event.organizer_id != self.get_user_id():
+        elif not self.auth.is_host or event.organizer_id != self.auth.owner:
             self.write_error(403, 'Insufficient permission')
         else:
             logging.info(f'Adding image to event {event_id}')
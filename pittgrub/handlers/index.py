@@ -6,8 +6,10 @@ Author: Mark Silvis
 
 import logging
 
+from tornado.ioloop import IOLoop
+
 from __init__ import __version__
-from db import health_check
+from db import health_check, pool_stats
 from emailer import send_email_list_confirmation
 from handlers.base import BaseHandler, CORSHandler
 from service.user import add_to_email_list, remove_from_email_list
@@ -16,11 +18,11 @@ from validate_email import validate_email
 
 
 class EmailListAddHandler(CORSHandler):
-    def get(self, path):
+    async def get(self, path):
         email = path.replace('/', '')
 
-        if email and validate_email(email) and add_to_email_list(email):
-            send_email_list_confirmation(email)
+        if email and validate_email(email) and await self.run_db(add_to_email_list, email):
+            await IOLoop.current().run_in_executor(None, send_email_list_confirmation, email)
             self.success(200)
         else:
             self.write_error(400)
@@ -29,10 +31,10 @@ class EmailListAddHandler(CORSHandler):
 
 class EmailListRemoveHandler(CORSHandler):
     """Remove email signup"""
-    def get(self, path):
+    async def get(self, path):
         email = path.replace('/', '')
 
-        if email and validate_email(email) and remove_from_email_list(email):
+        if email and validate_email(email) and await self.run_db(remove_from_email_list, email):
             self.success(200, 'Success')
         else:
             self.write_error(400)
@@ -42,13 +44,21 @@ class EmailListRemoveHandler(CORSHandler):
 class HealthHandler(BaseHandler):
     """Health status of server"""
 
-    def get(self, path):
+    def initialize(self, token_service: 'JwtTokenService'=None):
+        self.token_service = token_service
+
+    async def get(self, path):
         logging.info("Health status check")
         status = {
             'version': __version__,
             'status': 'up',
-            'database': 'OK' if health_check() else 'ERR'
+            'database': 'OK' if await self.run_db(health_check) else 'ERR'
         }
+        db_pool = pool_stats()
+        if db_pool is not None:
+            status['db_pool'] = db_pool
+        if self.token_service is not None and self.token_service.cache_stats() is not None:
+            status['token_cache'] = self.token_service.cache_stats()
         self.write(json_esc(status))
         self.finish()
 
@@ -3,63 +3,74 @@ Login, signup, and token handler
 Author: Mark Silvis
 """
 
+from tornado.ioloop import IOLoop
 from validate_email import validate_email
 
 from db import UserReferral, UserVerification
 from emailer import send_verification_email
-from handlers.base import CORSHandler, SecureHandler
+from handlers.base import CORSHandler, RateLimitMixin, SecureHandler
 from handlers.response import Payload
 from service.analytics import log_activity, Activity
 from service.auth import (
     JwtTokenService,
+    get_login_credentials,
     login,
     signup,
     host_signup,
     get_possible_affiliations
 )
+from service.credentials import CredentialService
+from service.revocation import revoke_user_tokens
 from service.user import get_user_by_email
 
 
-class LoginHandler(CORSHandler):
+class LoginHandler(RateLimitMixin, CORSHandler):
+    rate_limit = 'login'
     required_fields = set(['email', 'password'])
 
-    def initialize(self, token_service: JwtTokenService):
+    def initialize(self, token_service: JwtTokenService, credential_service: CredentialService):
         self.token_service = token_service
+        self.credential_service = credential_service
 
-    def post(self, path):
+    async def post(self, path):
         data = self.get_data()
         email = data['email']
         password = data['password']
-        user = login(email, password)
-        if user is None:
+        credentials = await self.run_db(get_login_credentials, email)
+        if credentials is None or not await self.credential_service.verify(password, credentials.password):
             self.write_error(401, 'Error: Incorrect email or password')
         else:
-            access_token = self.token_service.create_access_token(owner=user.id)
-            refresh_token = self.token_service.create_refresh_token(owner=user.id)
+            user = await self.run_db(login, credentials)
+            access_token = self.token_service.create_access_token(
+                owner=user.id, roles=credentials.roles)
+            refresh_token = self.token_service.create_refresh_token(
+                owner=user.id, roles=credentials.roles, password=credentials.password)
             self.success(payload=dict(
                 user=user.json(),
                 refresh_token=refresh_token.decode(),
                 access_token=access_token.decode()
             ))
-            log_activity(user.id, Activity.LOGIN)
         self.finish()
 
 
 class LogoutHandler(SecureHandler):
 
-    def get(self, path):
-        user_id = self.get_user_id()
-        log_activity(user_id, Activity.LOGOUT)
+    async def get(self, path):
+        user_id = self.auth.owner
+        await self.run_db(revoke_user_tokens, user_id)
+        await self.run_db(log_activity, user_id, Activity.LOGOUT)
         self.success(status=200, payload="Successfully logged out\n")
 
 
-class SignupHandler(CORSHandler):
+class SignupHandler(RateLimitMixin, CORSHandler):
+    rate_limit = 'signup'
     required_fields = set(['email', 'password'])
 
-    def initialize(self, token_service: JwtTokenService):
+    def initialize(self, token_service: JwtTokenService, credential_service: CredentialService):
         self.token_service = token_service
+        self.credential_service = credential_service
 
-    def post(self, path: str):
+    async def post(self, path: str):
         # new user signup
         # decode json
         data = self.get_data()
@@ -68,14 +79,17 @@ class SignupHandler(CORSHandler):
             self.write_error(400, 'Invalid email address')
         else:
             name = data['name'] if 'name' in data else None
-            user, code = signup(data['email'], data['password'], name)
+            password = await self.credential_service.hash(data['password'])
+            user, code = await self.run_db(signup, data['email'], password, name)
             if user is None:
                 self.write_error(400, 'Error: user already exists with that email address')
             else:
                 if code is not None:
-                    send_verification_email(to=user.email, code=code)
-                access_token = self.token_service.create_access_token(owner=user.id)
-                refresh_token = self.token_service.create_refresh_token(owner=user.id)
+                    await IOLoop.current().run_in_executor(None, send_verification_email, user.email, code)
+                access_token = self.token_service.create_access_token(
+                    owner=user.id, roles=user.role_names)
+                refresh_token = self.token_service.create_refresh_token(
+                    owner=user.id, roles=user.role_names, password=password)
                 self.success(payload=dict(
                     user=user.json(),
                     refresh_token=refresh_token.decode(),
@@ -88,17 +102,19 @@ class PrimaryAffiliationHandler(CORSHandler):
     def initialize(self, token_service: JwtTokenService):
         self.token_service = token_service
 
-    def get(self, path: str):
-        possible = get_possible_affiliations()
+    async def get(self, path: str):
+        possible = await self.run_db(get_possible_affiliations)
         self.success(payload=Payload(possible))
 
-class HostSignupHandler(CORSHandler):
+class HostSignupHandler(RateLimitMixin, CORSHandler):
+    rate_limit = 'signup_host'
     required_fields = set(['email', 'password', 'name', 'primary_affiliation'])
 
-    def initialize(self, token_service: JwtTokenService):
+    def initialize(self, token_service: JwtTokenService, credential_service: CredentialService):
         self.token_service = token_service
+        self.credential_service = credential_service
 
-    def post(self, path: str):
+    async def post(self, path: str):
         # new user signup requesting host status
         data = self.get_data()
         # check email is valid
@@ -106,20 +122,22 @@ class HostSignupHandler(CORSHandler):
             self.write_error(400, 'Invalid email address')
         else:
             email = data.get('email')
-            password = data.get('password')
+            password = await self.credential_service.hash(data.get('password'))
             name = data.get('name')
             primary_affiliation = data.get('primary_affiliation')
             reason = data.get('reason')
-            user, code, valid_aff = host_signup(email, password, name, primary_affiliation, reason)
+            user, code, valid_aff = await self.run_db(host_signup, email, password, name, primary_affiliation, reason)
             if not valid_aff:
                 self.write_error(400, 'Error: not a valid primary affiliation')
             elif user is None and code is None:
                 self.write_error(400, 'Error: user already exists with that email address')
             else:
                 if code is not None:
-                    send_verification_email(to=user.email, code=code)
-                access_token = self.token_service.create_access_token(owner=user.id)
-                refresh_token = self.token_service.create_refresh_token(owner=user.id)
+                    await IOLoop.current().run_in_executor(None, send_verification_email, user.email, code)
+                access_token = self.token_service.create_access_token(
+                    owner=user.id, roles=user.role_names)
+                refresh_token = self.token_service.create_refresh_token(
+                    owner=user.id, roles=user.role_names, password=password)
                 self.success(payload=dict(
                     user=user.json(),
                     refresh_token=refresh_token.decode(),
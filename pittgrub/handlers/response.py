@@ -5,6 +5,7 @@ Author: Mark Silvis
 import datetime
 from http import HTTPStatus
 from typing import Dict, List, Optional, Union
+from urllib.parse import parse_qsl, urlencode, urlsplit, urlunsplit
 from util import json_esc
 
 from domain.data import Data
@@ -51,6 +52,18 @@ class Payload():
         else:
             self._links[rel] = link
 
+    def add_next_link(self, uri: str, cursor: Optional[str]) -> None:
+        """Add link to the next page of a paged response
+        uri: uri of this page
+        cursor: cursor of the next page (None on the last page, no link is added)
+        """
+        if cursor is None:
+            return
+        url = urlsplit(uri)
+        args = [(key, val) for key, val in parse_qsl(url.query) if key != 'cursor']
+        args.append(('cursor', cursor))
+        self.add_link('next', urlunsplit(url._replace(query=urlencode(args))))
+
     def add_links(self, **links) -> None:
         """Add links to payload
         Overwrites link if href already exists
@@ -1,9 +1,12 @@
 import logging
 
+import jwt
 from jwt import get_unverified_header
+from tornado.web import Finish
 
 from handlers.base import BaseHandler, SecureHandler
 from service.auth import JwtTokenService
+from service.revocation import is_disabled, is_revoked
 from service.user import get_user, update_expo_token
 
 
@@ -13,19 +16,23 @@ class TokenRequestHandler(BaseHandler):
     def initialize(self, token_service: JwtTokenService):
         self.token_service = token_service
 
-    def post(self, path: str):
+    async def post(self, path: str):
         token = self.get_data()['token']
         if not get_unverified_header(token).get('tok') == 'ref':
             self.write_error(401, f'Error: Refresh token required')
         else:
-            user_id = self.token_service.decode_refresh_token(token).get('own')
-            user = get_user(user_id)
-            if user.disabled:
+            claims = await self.run_db(self.token_service.decode_refresh_token, token)
+            user_id = claims.get('own')
+            if is_revoked(user_id, claims.get('iat', 0)):
+                self.write_error(401, f'Error: Refresh token has been revoked')
+                raise Finish()
+            user = await self.run_db(get_user, user_id)
+            if user.disabled or is_disabled(user_id):
                 self.write_error(403, f'Error: user account disabled')
             # elif not user.active:
             #     self.write_error(401, f'Error: user activation required')
             else:
-                access_token = self.token_service.create_access_token(owner=user.id)
+                access_token = self.token_service.create_access_token(owner=user.id, roles=user.role_names)
                 self.success(payload=dict(
                     user=user.json(),
                     access_token=access_token.decode()
@@ -39,10 +46,13 @@ class TokenValidationHandler(BaseHandler):
     def initialize(self, token_service: JwtTokenService):
         self.token_service = token_service
 
-    def post(self, path: str):
+    async def post(self, path: str):
         token = self.get_data().get('token')
         try:
-            valid = self.token_service.validate_token(token)
+            valid = await self.run_db(self.token_service.validate_token, token)
+            if valid:
+                claims = jwt.decode(token, verify=False)
+                valid = not is_revoked(claims.get('own'), claims.get('iat', 0))
             self.success(payload=dict(valid=valid))
         except:
             self.write_error(400, f'Error: Invalid token')
@@ -52,11 +62,11 @@ class TokenValidationHandler(BaseHandler):
 class NotificationTokenHandler(SecureHandler):
     required_fields = set(['token'])
 
-    def post(self, path):
-        user_id = self.get_user_id()
+    async def post(self, path):
+        user_id = self.auth.owner
         token = self.get_data().get('token')
         try:
-            update_expo_token(user_id, token)
+            await self.run_db(update_expo_token, user_id, token)
             self.success(204)
         except Exception as e:
             logging.error(e)
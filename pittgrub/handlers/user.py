@@ -2,24 +2,26 @@ import base64
 import logging
 
 from tornado.escape import json_decode
+from tornado.ioloop import IOLoop
 from tornado.web import Finish
 
-from db import UserStatus
+from db import UserStatus, aio
 from emailer import send_verification_email, send_password_reset_email
-from service.property import get_property, set_property
+from service.credentials import CredentialService
 from service.user import (
     get_user,
+    get_user_async,
     get_user_profile,
     get_user_by_email,
+    get_user_password_hash,
     get_user_verification,
-    get_user_verification_code,
     update_user_password,
     update_user_profile,
-    change_user_password,
     add_location,
+    add_location_async,
     verify_user
 )
-from .base import CORSHandler, SecureHandler
+from .base import CORSHandler, RateLimitMixin, SecureHandler
 
 
 class UserHandler(SecureHandler):
@@ -27,9 +29,12 @@ class UserHandler(SecureHandler):
     Get user data for requesting user
     """
 
-    def get(self, path: str):
-        user_id = self.get_user_id()
-        user = get_user(user_id)
+    async def get(self, path: str):
+        user_id = self.auth.owner
+        if aio.available():
+            user = await get_user_async(user_id)
+        else:
+            user = await self.run_db(get_user, user_id)
         if not user:
             logging.warning(f'User {user_id} has token but not found?')
             self.write_error(400, f'User not found with id: {user_id}')
@@ -40,14 +45,14 @@ class UserHandler(SecureHandler):
 
 class UserProfileHandler(SecureHandler):
 
-    def get(self, path):
-        user_id = self.get_user_id()
-        user_profile = get_user_profile(user_id)
+    async def get(self, path):
+        user_id = self.auth.owner
+        user_profile = await self.run_db(get_user_profile, user_id)
         self.success(200, user_profile)
         self.finish()
 
-    def post(self, path):
-        user_id = self.get_user_id()
+    async def post(self, path):
+        user_id = self.auth.owner
         data = self.get_data()
         logging.info(f'Updating settings for user {user_id}, settings {data}')
         food = data.get('food_preferences')
@@ -65,41 +70,50 @@ class UserProfileHandler(SecureHandler):
         if eager is not None and (not isinstance(eager, int) or not 1 <= eager <= 5):
             self.write_error(400, f'Eagerness value must be from 1 to 5')
             raise Finish()
-        update_user_profile(user_id, food, pantry, eager)
+        await self.run_db(update_user_profile, user_id, food, pantry, eager)
         self.success(204)
         self.finish()
 
 class UserPasswordHandler(CORSHandler, SecureHandler):
     required_fields = set(['old_password', 'new_password'])
 
-    def post(self):
-        user_id = self.get_user_id()
+    def initialize(self, token_service: 'JwtTokenService', credential_service: CredentialService):
+        super().initialize(token_service)
+        self.credential_service = credential_service
+
+    async def post(self):
+        user_id = self.auth.owner
         data = self.get_data()
         old_pass = data.get('old_password')
         new_pass = data.get('new_password')
-        if change_user_password(user_id, old_pass, new_pass):
+        hashed = await self.run_db(get_user_password_hash, user_id)
+        if await self.credential_service.verify(old_pass, hashed):
+            password = await self.credential_service.hash(new_pass)
+            await self.run_db(update_user_password, user_id, password)
             self.success(status=200)
         else:
             self.write_error(400, 'Incorrect password')
         self.finish()
 
 
-class UserPasswordResetHandler(CORSHandler):
+class UserPasswordResetHandler(RateLimitMixin, CORSHandler):
+    rate_limit = 'password_reset'
 
-    def initialize(self, token_service: 'JwtTokenService', executor: 'ThreadPoolExecutor'):
+    def initialize(self, token_service: 'JwtTokenService', credential_service: CredentialService, executor: 'ThreadPoolExecutor'):
         self.token_service = token_service
+        self.credential_service = credential_service
         self.executor = executor
 
-    def post(self, path):
+    async def post(self, path):
         # user forgot password
         # we need to generate a one-time use reset token
         # and email them a password reset link
         data = json_decode(self.request.body)
         if 'email' in data:
             # they are requesting the reset link
-            user = get_user_by_email(data['email'])
+            user = await self.run_db(get_user_by_email, data['email'])
             if user:
-                token = self.token_service.create_password_reset_token(user.id)
+                token = await self.run_db(self.token_service.create_password_reset_token, user.id)
                 encoded = base64.b64encode(token).decode()
                 logging.info('encoded: ', encoded)
                 self.executor.submit(send_password_reset_email, user.email, encoded)
@@ -116,13 +130,14 @@ class UserPasswordResetHandler(CORSHandler):
                 logging.warning(f'Encountered invalid token: {data["token"]}')
                 self.write_error(400, 'Password reset failed, invalid token')
                 raise Finish()
-            owner = self.token_service.decode_password_token(token, False)['own']
-            user = get_user(owner)
+            claims = await self.run_db(self.token_service.decode_password_token, token, False)
+            owner = claims['own']
+            user = await self.run_db(get_user, owner)
             if user is not None:
                 try:
-                    if self.token_service.validate_token(token):
-                        password = data['password']
-                        if not update_user_password(owner, password):
+                    if await self.run_db(self.token_service.validate_token, token):
+                        password = await self.credential_service.hash(data['password'])
+                        if not await self.run_db(update_user_password, owner, password):
                             logging.error(f'Failed password reset for user {owner.id}')
                             self.write_error(500, 'Password reset failed')
                         else:
@@ -143,28 +158,36 @@ class UserPasswordResetHandler(CORSHandler):
 class UserLocationHandler(SecureHandler):
     required_fields = set(['latitude', 'longitude'])
 
-    def post(self, path):
-        user_id = self.get_user_id()
+    async def post(self, path):
+        user_id = self.auth.owner
         data = self.get_data()
-        add_location(user_id, data['latitude'], data['longitude'], data.get('time'))
+        if aio.available():
+            await add_location_async(user_id, data['latitude'], data['longitude'], data.get('time'))
+        else:
+            await self.run_db(add_location, user_id, data['latitude'], data['longitude'], data.get('time'))
         self.success(204)
         self.finish()
 
 
-class UserVerificationHandler(SecureHandler):
-    def get(self, path):
-        user_id = self.get_user_id()
+class UserVerificationHandler(RateLimitMixin, SecureHandler):
+    rate_limit = 'verify'
+    rate_limit_methods = ('GET', 'POST')
+
+    async def get(self, path):
+        user_id = self.auth.owner
         try:
-            user = get_user(user_id)
-            threshold = int(get_property('user.threshold'))
+            user = await self.run_db(get_user, user_id)
             if user.active:
                 logging.info(f"User {user_id} is already active")
                 self.write_error(400, "Error: user already active")
-            elif user.status == "REQUESTED" and (threshold > 0 or get_user_verification_code(user_id) is not None):
-                code = get_user_verification(user_id)
-                send_verification_email(to=user.email, code=code)
-                set_property('user.threshold', str(threshold-1))
-                self.success(status=204)
+            elif user.status == "REQUESTED":
+                # slot and code commit together, before the email goes out
+                code = await self.run_db(get_user_verification, user_id)
+                if code is None:
+                    self.write_error(403, "User has not yet been permitted")
+                else:
+                    await IOLoop.current().run_in_executor(None, send_verification_email, user.email, code)
+                    self.success(status=204)
             elif user.status == 'VERIFIED' or user.status == 'ACCEPTED':
                 self.write_error(400, "User is already verified")
             else:
@@ -176,15 +199,15 @@ class UserVerificationHandler(SecureHandler):
         finally:
             self.finish()
 
-    def post(self, path):
+    async def post(self, path):
         # decode json
-        user_id = self.get_user_id()
+        user_id = self.auth.owner
         data = self.get_data()
         code = data.get('code')
         if not code:
             self.write_error(400, 'Missing verification code')
         else:
-            if verify_user(code, user_id):
+            if await self.run_db(verify_user, code, user_id):
                 self.success(status=204)
             else:
                 self.write_error(400, 'Invalid verification code')
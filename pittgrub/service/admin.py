@@ -1,8 +1,9 @@
 import datetime
 from typing import List
 
-from db import User, UserHostRequest, UserReferral, UserRole, session_scope
+from db import Page, User, UserHostRequest, UserReferral, UserRole, loader, reference, session_scope
 from domain.data import UserReferralData, UserHostRequestData
+from service.auth import invalidate_user_roles
 from . import MissingUserError
 
 
@@ -16,18 +17,16 @@ def _is_admin(session, id: int) -> bool:
     return user.is_admin
 
 def is_admin(id: int) -> bool:
-    with session_scope() as session:
+    with session_scope(readonly=True, owner=id) as session:
         return _is_admin(session, id)
 
-def get_pending_host_requests():
-    with session_scope() as session:
-        host_requests = UserHostRequest.get_all_pending(session)
-        print('found host requests')
-        print(host_requests)
-        return UserHostRequestData.list(host_requests)
+def get_pending_host_requests(limit: int, cursor: str=None) -> Page:
+    with session_scope(readonly=True) as session:
+        host_requests, next = UserHostRequest.get_pending_page(session, limit, cursor, loader.HOST_REQUEST)
+        return Page(UserHostRequestData.list(host_requests), next)
 
 def get_referrals(reference: int) -> List[UserReferralData]:
-    with session_scope() as session:
+    with session_scope(readonly=True, owner=reference) as session:
         refs = UserReferral.get_all_by_reference(session, reference)
         return UserReferralData.list(refs)
 
@@ -42,4 +41,9 @@ def host_approval(user_id: int, admin_id: int) -> bool:
         user_host_req.approved_by = admin_id
         UserRole.create_host(session, user_id)
         session.merge(user_host_req)
+    invalidate_user_roles(user_id)
     return True
+
+def refresh_reference_data():
+    """Reload roles, food preferences and affiliations in every worker after they change"""
+    reference.refresh()
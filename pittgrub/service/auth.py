@@ -1,31 +1,121 @@
+import hashlib
 import logging
+import time
 from datetime import datetime, timedelta
-from typing import Any, Dict, Optional, Tuple
+from typing import Any, Dict, List, Optional, Tuple
 
 import jwt
 from jwt import DecodeError, ExpiredSignatureError
+from sqlalchemy.orm import joinedload
 
 from db import (
+    Activity,
     User,
+    UserActivity,
     UserHostRequest,
     UserReferral,
+    UserRole,
     UserVerification,
     PrimaryAffiliation,
     Property,
+    Role,
+    reference,
     session_scope,
 )
 from domain.data import UserData, PrimaryAffiliationData
 from emailer import send_verification_email
-from service.property import get_property, set_property
+from service.revocation import timestamp
+from util import LRUCache
+
+
+# password hashes used to sign refresh and password reset tokens
+# keyed by user id, invalidated when the user's password changes
+_key_cache = LRUCache(maxsize=4096, ttl=300)
+
+
+def configure_key_cache(maxsize: int, ttl: float):
+    """
+    Resize signing key cache
+    :param maxsize: maximum number of cached keys
+    :param ttl: seconds before a cached key is reloaded
+    """
+    global _key_cache
+    _key_cache = LRUCache(maxsize=maxsize, ttl=ttl)
+
+
+def invalidate_user_key(user_id: int):
+    """
+    Drop cached signing key for user
+    Must be called after the user's password changes
+    """
+    _key_cache.invalidate(user_id)
+
+
+def _get_user_key(user_id: int, cached: bool=True) -> str:
+    """
+    Get user's password hash for token signing, from cache when possible
+    :param user_id: token owner
+    :param cached: allow a cached key (default: True)
+    :raises DecodeError: if user does not exist
+    """
+    key = _key_cache.get(user_id) if cached else None
+    if key is None:
+        with session_scope(readonly=True, primary=True) as session:
+            key = session.query(User.password).filter(User.id == user_id).scalar()
+        if key is None:
+            raise DecodeError(f'Token owner not found: {user_id}')
+        _key_cache.put(user_id, key)
+    return key
+
+
+# role names for minting tokens when callers only have a user id
+# keyed by user id, invalidated when the user's roles change
+_role_cache = LRUCache(maxsize=4096, ttl=300)
+
+
+def configure_role_cache(maxsize: int, ttl: float):
+    """
+    Resize role cache
+    :param maxsize: maximum number of cached users
+    :param ttl: seconds before cached roles are reloaded
+    """
+    global _role_cache
+    _role_cache = LRUCache(maxsize=maxsize, ttl=ttl)
+
+
+def invalidate_user_roles(user_id: int):
+    """
+    Drop cached roles for user
+    Must be called after the user's roles change
+    """
+    _role_cache.invalidate(user_id)
+
+
+def _get_user_roles(user_id: int) -> List[str]:
+    """Get user's role names, from cache when possible"""
+    roles = _role_cache.get(user_id)
+    if roles is None:
+        with session_scope(readonly=True, primary=True) as session:
+            role_ids = [role_id for role_id, in session.query(UserRole.role_id).filter(UserRole.user_id == user_id)]
+        roles = [role.name for role in reference.get_all(Role, role_ids)]
+        _role_cache.put(user_id, roles)
+    return roles
 
 
 class JwtTokenService:
     issuer: str = 'PittGrub'
 
-    def __init__(self, secret: str, alg: str='HS256'):
+    def __init__(self, secret: str, alg: str='HS256', cache_size: int=0):
+        """
+        :param secret: signing secret
+        :param alg: signing algorithm (default: HS256)
+        :param cache_size: number of verified access tokens to cache
+            (default: 0, cache disabled)
+        """
         assert secret
         self.__secret = secret
         self.__alg = alg
+        self.__token_cache = LRUCache(maxsize=cache_size) if cache_size > 0 else None
 
     @property
     def secret(self):
@@ -35,38 +125,40 @@ class JwtTokenService:
     def alg(self):
         return self.__alg
 
-    def create_access_token(self, owner: int, expires: datetime=None) -> bytes:
+    def cache_stats(self) -> Optional[Dict[str, int]]:
+        """Verified token cache counters, or None if cache is disabled"""
+        return self.__token_cache.stats() if self.__token_cache is not None else None
+
+    def create_access_token(self, owner: int, expires: datetime=None, roles: List[str]=None) -> bytes:
         assert owner, 'Owner required'
         assert expires is None or expires >= datetime.utcnow(), 'Expiration must be in the future'
         issued = datetime.utcnow()
         expires = expires or datetime.utcnow()+timedelta(hours=2)
 
-        with session_scope() as session:
-            user = User.get_by_id(session, owner)
-            roles = [role.name for role in user.roles]
-            key = self.secret
-            token = jwt.encode(
-                payload={'own': owner, 'roles': ','.join(roles),
-                         'iss': self.issuer, 'iat': issued, 'exp': expires,},
-                key=key,
-                algorithm=self.alg,
-                headers={'tok': 'acc'})
+        roles = roles if roles is not None else _get_user_roles(owner)
+        token = jwt.encode(
+            payload={'own': owner, 'roles': ','.join(roles),
+                     'iss': self.issuer, 'iat': timestamp(issued), 'exp': expires,},
+            key=self.secret,
+            algorithm=self.alg,
+            headers={'tok': 'acc'})
         return token
 
-    def create_refresh_token(self, owner: int) -> bytes:
+    def create_refresh_token(self, owner: int, roles: List[str]=None, password: str=None) -> bytes:
         assert owner, 'Owner required'
         issued = datetime.utcnow()
 
-        with session_scope() as session:
-            user = User.get_by_id(session, owner)
-            roles = [role.name for role in user.roles]
-            key = self.secret + user.password
-            token = jwt.encode(
-                payload={'own': owner, 'roles': ','.join(roles),
-                         'iss': self.issuer, 'iat': issued,},
-                key=key,
-                algorithm=self.alg,
-                headers={'tok': 'ref'})
+        roles = roles if roles is not None else _get_user_roles(owner)
+        if password is None:
+            password = _get_user_key(owner)
+        else:
+            _key_cache.put(owner, password)
+        token = jwt.encode(
+            payload={'own': owner, 'roles': ','.join(roles),
+                     'iss': self.issuer, 'iat': timestamp(issued),},
+            key=self.secret + password,
+            algorithm=self.alg,
+            headers={'tok': 'ref'})
         return token
 
     def create_password_reset_token(self, owner: int, expires: datetime=None):
@@ -76,39 +168,72 @@ class JwtTokenService:
         issued = datetime.utcnow()
         expires = expires or datetime.utcnow()+timedelta(hours=24)
 
-        with session_scope() as session:
+        with session_scope(readonly=True, primary=True) as session:
             user = User.get_by_id(session, owner)
             roles = [role.name for role in user.roles]
+            _key_cache.put(owner, user.password)
             key = user.password
             token = jwt.encode(
                 payload={'own': owner, 'roles': ','.join(roles),
-                         'iss': self.issuer, 'iat': issued, 'exp': expires,},
+                         'iss': self.issuer, 'iat': timestamp(issued), 'exp': expires,},
                 key=key,
                 algorithm=self.alg,
                 headers={'tok': 'pas'})
         return token
 
+    def decode_token(self, token: str, verify_exp: bool=False) -> Tuple[Optional[str], Optional[Dict[str, Any]]]:
+        """
+        Decode an access or refresh token, reading its header only once
+        :param token: stringified jwt
+        :param verify_exp: verify access token expiration
+        :return: (token type, claims), or (token type, None) for other token types
+        :raises DecodeError: if token fails to be decoded
+        :raises ExpiredSignatureError: if verifying and token is expired
+        """
+        assert token, 'Token required'
+        token_type = jwt.get_unverified_header(token).get('tok')
+        if token_type == 'acc':
+            return token_type, self._decode_access_token(token, verify_exp)
+        elif token_type == 'ref':
+            return token_type, self._decode_refresh_token(token)
+        return token_type, None
+
     def decode_access_token(self, token: str, verify_exp: bool=False) -> Dict[str, Any]:
         assert token, 'Token required'
         assert jwt.get_unverified_header(token).get('tok') == 'acc', 'Access token required'
-        return jwt.decode(token, key=self.secret, algorithms=[self.alg], options={'verify_exp': verify_exp})
+        return self._decode_access_token(token, verify_exp)
+
+    def _decode_access_token(self, token: str, verify_exp: bool) -> Dict[str, Any]:
+        if self.__token_cache is None:
+            return jwt.decode(token, key=self.secret, algorithms=[self.alg], options={'verify_exp': verify_exp})
+        # tokens are cached by digest until they expire,
+        # so a cache hit is always an unexpired, verified token
+        digest = hashlib.blake2b(token.encode() if isinstance(token, str) else token, digest_size=16).digest()
+        claims = self.__token_cache.get(digest)
+        if claims is None:
+            claims = jwt.decode(token, key=self.secret, algorithms=[self.alg], options={'verify_exp': verify_exp})
+            remaining = claims.get('exp', 0) - time.time()
+            if remaining > 0:
+                self.__token_cache.put(digest, claims, ttl=remaining)
+        return dict(claims)
 
     def decode_refresh_token(self, token: str) -> Dict[str, Any]:
         assert token, 'Token required'
         assert jwt.get_unverified_header(token).get('tok') == 'ref', 'Refresh token required'
+        return self._decode_refresh_token(token)
+
+    def _decode_refresh_token(self, token: str) -> Dict[str, Any]:
         user = jwt.decode(token, verify=False).get('own')
-        with session_scope() as session:
-            password = User.get_by_id(session, user).password
-        key = self.secret + password
+        key = self.secret + _get_user_key(user)
         return jwt.decode(token.encode(), key=key, algorithms=[self.alg], options={'verify_exp': False})
 
     def decode_password_token(self, token: str, verify_exp: bool=False) -> Dict[str, Any]:
         assert token, 'Token required'
         assert jwt.get_unverified_header(token).get('tok') == 'pas', 'Password reset token required'
         user = jwt.decode(token, verify=False).get('own')
-        with session_scope() as session:
-            password = User.get_by_id(session, user).password
-        return jwt.decode(token, key=password, algorithms=[self.alg], options={'verify_exp': verify_exp})
+        # always load a fresh key, since reset tokens must stop working
+        # in every worker as soon as the password changes
+        return jwt.decode(token, key=_get_user_key(user, cached=False), algorithms=[self.alg], options={'verify_exp': verify_exp})
 
     def validate_token(self, token: str) -> bool:
         """
@@ -134,59 +259,89 @@ class JwtTokenService:
             return False
 
 
-def login(email: str, password: str) -> 'UserData':
+class LoginCredentials:
+    """User loaded for login, with what is needed to verify and mint tokens"""
+
+    def __init__(self, user: User):
+        self.user = UserData(user)
+        self.roles = [role.name for role in user.roles]
+        self.password = user.password
+        self.verification = user._verification.code if user._verification else None
+
+
+def get_login_credentials(email: str) -> Optional[LoginCredentials]:
+    """
+    Load user, roles, and verification state in a single query
+    :param email: user email
+    :return: login credentials, or None if user not found
+    """
+    with session_scope(readonly=True, primary=True) as session:
+        user = session.query(User)\
+            .options(
+                joinedload(User._user_roles),
+                joinedload(User._verification))\
+            .filter(User.email == email)\
+            .one_or_none()
+        return None if user is None else LoginCredentials(user)
+
+
+def login(credentials: LoginCredentials) -> 'UserData':
+    """
+    Log user in after their credentials have been verified
+    Counts the login, sends a verification code if needed,
+    and records the activity in one transaction
+    :param credentials: verified login credentials
+    :return: user
+    """
+    user = credentials.user
+    code = None
     with session_scope() as session:
-        if User.verify_credentials(session, email, password):
-            user = User.get_by_email(session, email)
-            if not user.active:
-                verification = UserVerification.get_by_user(session, user.id)
-                threshold = int(get_property('user.threshold'))
-                if not verification and threshold > 0:
-                    verification = UserVerification.add(session, user_id=user.id)
-                    send_verification_email(to=email, code=verification.code)
-                    set_property('user.threshold', threshold-1)
-            user.login_count += 1
-            return UserData(user)
-    return None
+        session.query(User)\
+            .filter(User.id == user.id)\
+            .update({User.login_count: User.login_count + 1}, synchronize_session=False)
+        # slot and code commit together, the email goes out once they have
+        if not user.active and credentials.verification is None and Property.reserve(session, 'user.threshold'):
+            code = UserVerification.add(session, user_id=user.id).code
+        session.add(UserActivity(user.id, Activity.LOGIN))
+    if code is not None:
+        send_verification_email(to=user.email, code=code)
+    return user
 
 
 def signup(email: str, password: str, name: str=None) -> Tuple[Optional['UserData'], Optional[str]]:
     """
     Sign user up with
     :param email:
-    :param password:
+    :param password: password hash (see CredentialService.hash)
     :param name:
     :return:
     """
     with session_scope() as session:
         user = User.create(session, User(email=email, password=password))
         if user is not None:
+            # new user reads from primary until replicas have them
+            session.info['owner'] = user.id
             code = None
-            threshold = int(get_property('user.threshold'))
-            if threshold > 0:
+            if Property.reserve(session, 'user.threshold'):
                 logging.info("passed threshold")
                 code = UserVerification.add(session, user.id).code
-                set_property('user.threshold', str(threshold-1))
             else:
                 logging.info("failed threshold")
             return UserData(user), code
     return None, None
 
 def get_possible_affiliations():
-    with session_scope() as session:
-        return [PrimaryAffiliationData(aff) for aff in PrimaryAffiliation.get_all(session)]
-    return None
+    return PrimaryAffiliationData.list(reference.get_all(PrimaryAffiliation))
 
 def host_signup(email: str, password: str, name: str, primary_affiliation: int, reason: str=None) -> Tuple[Optional['UserData'], Optional[str], bool]:
     with session_scope() as session:
-        if PrimaryAffiliation.get_by_id(session,primary_affiliation) is not None:
+        if reference.get(PrimaryAffiliation, primary_affiliation) is not None:
             user = User.create(session, User(email=email, password=password, name=name, primary_affiliation=primary_affiliation))
             if user is not None:
+                session.info['owner'] = user.id
                 code = None
-                threshold = int(get_property('user.threshold'))
-                if threshold > 0:
+                if Property.reserve(session, 'user.threshold'):
                     code = UserVerification.add(session, user.id).code
-                    set_property('user.threshold', str(threshold-1))
                 host_request = UserHostRequest(user=user.id, primary_affiliation=primary_affiliation, reason=reason)
                 session.add(host_request)
                 return UserData(user), code, True
@@ -0,0 +1,65 @@
+"""
+Password hashing and verification
+bcrypt runs in a process pool so it never blocks the IOLoop
+"""
+
+from concurrent.futures import ProcessPoolExecutor
+from typing import Optional
+
+from passlib.hash import bcrypt_sha256
+from tornado.ioloop import IOLoop
+
+
+def hash_password(password: str) -> str:
+    """Hash password with bcrypt (runs in pool process)"""
+    return bcrypt_sha256.hash(password)
+
+
+def verify_password(password: str, hashed: str) -> bool:
+    """Verify password against bcrypt hash (runs in pool process)"""
+    return bcrypt_sha256.verify(password, hashed)
+
+
+class CredentialService:
+    """Asynchronous password hashing backed by a process pool"""
+
+    def __init__(self, procs: int=2):
+        """
+        :param procs: number of hashing processes (default: 2)
+        """
+        assert procs > 0, 'At least one hashing process required'
+        self.procs = procs
+        self._executor = None
+
+    @property
+    def executor(self) -> ProcessPoolExecutor:
+        # created on first use, so pool processes are
+        # spawned by each server worker rather than before fork
+        if self._executor is None:
+            self._executor = ProcessPoolExecutor(self.procs)
+        return self._executor
+
+    async def hash(self, password: str) -> str:
+        """
+        Hash password
+        :param password: plain text password
+        :return: password hash, stored as is by the Password column type
+        """
+        return await IOLoop.current().run_in_executor(self.executor, hash_password, password)
+
+    async def verify(self, password: str, hashed: Optional[str]) -> bool:
+        """
+        Verify password against hash
+        :param password: plain text password
+        :param hashed: stored password hash, or None if user wasn't found
+        :return: True if password matches
+            False if not
+        """
+        if not password or not hashed:
+            return False
+        return await IOLoop.current().run_in_executor(self.executor, verify_password, password, hashed)
+
+    def shutdown(self):
+        if self._executor is not None:
+            self._executor.shutdown(wait=False)
+            self._executor = None
@@ -6,11 +6,12 @@ from db import (
     Event,
     EventFoodPreference,
     EventImage,
-    User,
+    Page,
     UserAcceptedEvent,
     UserRecommendedEvent,
     session_scope
 )
+from db import loader
 from domain.data import (
     EventData,
     EventImageData,
@@ -21,7 +22,7 @@ from domain.data import (
 def create_event(title: str, organizer: int, start_date: 'datetime',
     end_date: 'datetime', servings: int, address: str, latitude, longitude,
     details: str=None, location: str=None, image: bool=False) -> EventData:
-    with session_scope() as session:
+    with session_scope(owner=organizer) as session:
         event = Event(
             title=title,
             organizer=organizer,
@@ -46,12 +47,12 @@ def create_event(title: str, organizer: int, start_date: 'datetime',
 
 
 def get_event(id: int) -> Optional[EventData]:
-    with session_scope() as session:
+    with session_scope(readonly=True, primary=True) as session:
         event = Event.get_by_id(session, id)
         return EventData(event)
 
 def get_event_by_user(id: int, user_id: int) -> Optional[EventViewData]:
-    with session_scope() as session:
+    with session_scope(readonly=True, owner=user_id) as session:
         event = Event.get_by_user(session, id, user_id)
         logging.info(f'got event {event}')
         event_image = EventImage.get_by_event(session, event.id)
@@ -59,65 +60,50 @@ def get_event_by_user(id: int, user_id: int) -> Optional[EventViewData]:
 
 
 def get_events() -> List[EventData]:
-    with session_scope() as session:
+    with session_scope(readonly=True) as session:
         events = Event.get_all(session)
         return EventData.list(events)
 
 
 def get_active() -> List[EventData]:
-    with session_scope() as session:
-        events = Event.get_all_active(session)
+    with session_scope(readonly=True) as session:
+        events = Event.get_all_active(session, loader.EVENT)
         return [EventData(e) for e in events]
 
 
-def get_active_by_user(user_id: int) -> List[EventViewData]:
-    with session_scope() as session:
-        # events = Event.get_all_active_by_user(session, user_id)
-        user = User.get_by_id(session, user_id)
-        events = Event.get_all_active(session)
-        user_accepted = {event.id for event in user.accepted_events}
-        user_recommended = {event.id for event in user.recommended_events}
-        views = [
-            EventViewData(event, event.id in user_accepted, event.id in user_recommended)
-            for event in events
-        ]
-        return views
+def get_active_by_user(user_id: int, limit: int, cursor: str=None) -> Page:
+    with session_scope(readonly=True, owner=user_id) as session:
+        rows, next = Event.get_all_active_by_user(session, user_id, limit, cursor)
+        return Page(EventViewData.from_rows(rows), next)
 
 
 def user_accept_event(event: int, user: int):
-    with session_scope() as session:
+    with session_scope(owner=user) as session:
         accepted = UserAcceptedEvent(event, user)
         session.add(accepted)
 
 
 def user_remove_event(event: int, user: int):
-    with session_scope() as session:
+    with session_scope(owner=user) as session:
         UserAcceptedEvent.remove(session, event, user)
 
 
-def user_accepted_events(user_id: int):
-    with session_scope() as session:
-        user = User.get_by_id(session, user_id)
-        accepted = user.accepted_events
-        return EventData.list(accepted)
+def user_accepted_events(user_id: int, limit: int, cursor: str=None) -> Page:
+    with session_scope(readonly=True, owner=user_id) as session:
+        accepted, next = Event.get_accepted_by_user(session, user_id, limit, cursor, loader.EVENT)
+        return Page(EventData.list(accepted), next)
 
 
-def user_recommended_events(user_id: int):
-    with session_scope() as session:
-        user = User.get_by_id(session, user_id)
-        recommended = user.recommended_events
-        return EventData.list(recommended)
+def user_recommended_events(user_id: int, limit: int, cursor: str=None) -> Page:
+    with session_scope(readonly=True, owner=user_id) as session:
+        recommended, next = Event.get_recommended_by_user(session, user_id, limit, cursor, loader.EVENT)
+        return Page(EventData.list(recommended), next)
 
 
-def user_recommended_events_valid(user_id: int):
-    with session_scope() as session:
-        user = User.get_by_id(session, user_id)
-        recommended = user.recommended_events
-        accepted = set([a.id for a in user.accepted_events])
-        return EventData.list(
-            [e for e in recommended
-            if e.end_date > datetime.now()
-            and e.id not in accepted])
+def user_recommended_events_valid(user_id: int, limit: int, cursor: str=None) -> Page:
+    with session_scope(readonly=True, owner=user_id) as session:
+        recommended, next = Event.get_recommended_by_user(session, user_id, limit, cursor, loader.EVENT, valid=True)
+        return Page(EventData.list(recommended), next)
 
 
 def set_food_preferences(id: int, prefs: List[int]):
@@ -126,7 +112,7 @@ def set_food_preferences(id: int, prefs: List[int]):
 
 
 def get_event_image_by_event(id: int) -> Optional[EventImageData]:
-    with session_scope() as session:
+    with session_scope(readonly=True) as session:
         event_image = EventImage.get_by_event(session, id)
         if event_image is None:
             return None
@@ -7,7 +7,7 @@ __property_cache = {}
 
 
 def init_cache():
-    with session_scope() as session:
+    with session_scope(readonly=True, primary=True) as session:
         properties = Property.get_cacheable(session)
         for prop in properties:
             logging.debug(f'property: {prop.name}')
@@ -19,7 +19,7 @@ def get_property(name: str) -> Optional[str]:
     if name in __property_cache:
         return __property_cache[name]
 
-    with session_scope() as session:
+    with session_scope(readonly=True, primary=True) as session:
         prop = Property.get_by_name(session, name)
         if prop is not None:
             return prop.value
@@ -31,3 +31,9 @@ def set_property(name: str, value):
         prop = Property.get_by_name(session, name)
         prop.value = str(value)
         session.merge(prop)
+
+
+def increment_property(name: str, n: int=1) -> bool:
+    """Add n to a counter property, see Property.increment"""
+    with session_scope() as session:
+        return Property.increment(session, name, n)
@@ -0,0 +1,113 @@
+"""
+Rate limiting
+Token buckets live in an anonymous shared memory map,
+so limits hold across server processes forked after creation
+"""
+
+import hashlib
+import mmap
+import multiprocessing
+import re
+import struct
+import time
+from typing import Iterable, Tuple
+
+
+# bucket slot: key hash, tokens remaining, last update (monotonic seconds)
+_SLOT = struct.Struct('=Qdd')
+
+
+def parse_budget(budget: str) -> Tuple[int, float]:
+    """
+    Parse budget from config
+    :param budget: requests per period, e.g. '10/60' for 10 requests every 60 seconds
+    :return: (capacity, period in seconds)
+    :raises ValueError: if budget is malformed
+    """
+    match = re.fullmatch(r'\s*(\d+)\s*/\s*(\d+(?:\.\d+)?)\s*', budget)
+    if match is None:
+        raise ValueError(f'Invalid rate limit budget: {budget}')
+    capacity, period = int(match.group(1)), float(match.group(2))
+    if capacity < 1 or period <= 0:
+        raise ValueError(f'Invalid rate limit budget: {budget}')
+    return capacity, period
+
+
+class RateLimiter:
+    """
+    Token bucket rate limiter shared between processes
+    Must be created before the server forks
+    """
+
+    def __init__(self, slots: int=65536, probes: int=8):
+        """
+        :param slots: number of buckets kept (default: 65536)
+        :param probes: slots searched per key before evicting the stalest (default: 8)
+        """
+        assert slots > 0, 'At least one bucket slot required'
+        self.slots = slots
+        self.probes = min(probes, slots)
+        self.budgets = dict()
+        self._mem = mmap.mmap(-1, slots * _SLOT.size)
+        self._lock = multiprocessing.Lock()
+
+    def configure(self, name: str, budget: str):
+        """
+        Set budget for name
+        :param name: budget name, e.g. 'login'
+        :param budget: requests per period, e.g. '10/60'
+        """
+        self.budgets[name] = parse_budget(budget)
+
+    @staticmethod
+    def _hash(name: str, key: str) -> int:
+        digest = hashlib.blake2b(f'{name}:{key}'.encode(), digest_size=8).digest()
+        return int.from_bytes(digest, 'little') or 1    # 0 marks an empty slot
+
+    def _find(self, key: int) -> Tuple[int, bool, float, float]:
+        """
+        Find slot for key, or the slot to replace
+        :return: (slot index, found, tokens, last update)
+        """
+        start = key % self.slots
+        victim, oldest = start, None
+        for i in range(self.probes):
+            index = (start + i) % self.slots
+            slot_key, tokens, stamp = _SLOT.unpack_from(self._mem, index * _SLOT.size)
+            if slot_key == key:
+                return index, True, tokens, stamp
+            if slot_key == 0:
+                return index, False, 0, 0
+            if oldest is None or stamp < oldest:
+                victim, oldest = index, stamp
+        return victim, False, 0, 0
+
+    def consume(self, checks: Iterable[Tuple[str, str]]) -> float:
+        """
+        Take one token from each bucket, only if all have one
+        Budgets which aren't configured are not limited
+        :param checks: (budget name, key) pairs, e.g. ('login', 'user@pitt.edu')
+        :return: 0 if allowed
+            seconds until allowed if not
+        """
+        now = time.monotonic()
+        wait = 0.0
+        with self._lock:
+            buckets = []
+            for name, key in checks:
+                budget = self.budgets.get(name)
+                if budget is None or key is None:
+                    continue
+                capacity, period = budget
+                rate = capacity / period
+                slot_key = self._hash(name, key)
+                index, found, tokens, stamp = self._find(slot_key)
+                tokens = min(capacity, tokens + (now - stamp) * rate) if found else capacity
+                if tokens < 1:
+                    wait = max(wait, (1 - tokens) / rate)
+                buckets.append((index, slot_key, tokens))
+            for index, slot_key, tokens in buckets:
+                if not wait:
+                    tokens -= 1
+                _SLOT.pack_into(self._mem, index * _SLOT.size, slot_key, tokens, now)
+        return wait
@@ -6,6 +6,7 @@ from db import (
     Event,
     User,
     UserRecommendedEvent,
+    loader,
     session_scope
 )
 
@@ -23,22 +24,23 @@ def should_recommend(user: User, event: Event) -> bool:
 def _event_recommendation(event: Union[Event, 'EventData'], with_params: Dict[str,Any]=None) -> List[User]:
     recommendations = []
     with session_scope() as session:
-        users = list(User.get_all(session))
-        event = Event.get_by_id(session, event.id)
+        users = list(User.get_all(session, loader.USER + loader.USER_PROFILE))
+        event = Event.get_by_id(session, event.id, loader.EVENT)
         capacity  = len(users)
+        pushed = 0
         if with_params is not None and 'avg_prob' in with_params:
             avprob = float(with_params['avg_prob'])
             capacity = event.servings / avprob if avprob > 0 else len(users)
-            shuffle(users); pushed = 0
+            shuffle(users)
         for user in users:
             if should_recommend(user, event) and pushed <= capacity:
-                user_rec = UserRecommendedEvent(event.id, user.id)
-                session.add(user_rec)
-                session.expunge(user)
                 recommendations.append(user)
                 pushed += 1
             elif pushed > capacity:
                 break
+        # recommended again: keep the first recommendation
+        UserRecommendedEvent.bulk_upsert(session, [dict(event_id=event.id, user_id=user.id) for user in recommendations])
+        session.expunge_all()
     return recommendations
 
 
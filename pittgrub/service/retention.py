@@ -0,0 +1,198 @@
+"""
+Retention for append-only tables
+Rolls UserActivity and UserLocation rows older than the retention window
+into daily summaries, then removes them
+
+On MySQL, tables partitioned by day (see db/schema.sql) drop whole partitions
+and get new ones ahead of time; other tables delete a day at a time
+"""
+
+import logging
+import threading
+from datetime import date, datetime, timedelta
+from typing import List, Optional, Tuple
+
+from sqlalchemy import and_, func, literal, select, text
+from sqlalchemy.types import Date
+
+from db import UserActivity, UserActivityDaily, UserLocation, UserLocationDaily, session_scope
+
+
+# days of raw rows kept per table, set by configure_retention()
+__retention = dict()
+
+# daily partitions kept ahead of today
+__partitions_ahead = 7
+
+# a run is skipped while the previous one is still going
+__running = threading.Lock()
+
+
+def _rollup_activity(session, day: date):
+    activity, summary = UserActivity.__table__, UserActivityDaily.__table__
+    start = datetime.combine(day, datetime.min.time())
+    session.execute(summary.delete().where(summary.c.day == day))
+    session.execute(summary.insert().from_select(
+        ['day', 'user_id', 'activity', 'count'],
+        select([literal(day, Date), activity.c.user_id, activity.c.activity, func.count()])
+        .where(and_(activity.c.time >= start, activity.c.time < start + timedelta(days=1)))
+        # activity without a user is summed under user_id NULL
+        .group_by(activity.c.user_id, activity.c.activity)))
+
+
+def _rollup_location(session, day: date):
+    location, summary = UserLocation.__table__, UserLocationDaily.__table__
+    start = datetime.combine(day, datetime.min.time())
+    session.execute(summary.delete().where(summary.c.day == day))
+    session.execute(summary.insert().from_select(
+        ['day', 'user_id', 'pings', 'first', 'last', 'latitude', 'longitude'],
+        select([literal(day, Date), location.c.user_id, func.count(),
+                func.min(location.c.time), func.max(location.c.time),
+                func.avg(location.c.latitude), func.avg(location.c.longitude)])
+        .where(and_(location.c.time >= start, location.c.time < start + timedelta(days=1)))
+        .group_by(location.c.user_id)))
+
+
+# retained tables: model and daily rollup
+TABLES = {
+    'UserActivity': (UserActivity, _rollup_activity),
+    'UserLocation': (UserLocation, _rollup_location),
+}
+
+
+def configure_retention(activity_days: int=90, location_days: int=30, partitions_ahead: int=7):
+    """
+    Set retention windows
+    :param activity_days: days of UserActivity kept (0 to keep forever)
+    :param location_days: days of UserLocation kept (0 to keep forever)
+    :param partitions_ahead: daily partitions created ahead of today
+    """
+    global __partitions_ahead
+    __retention.clear()
+    for table, days in (('UserActivity', activity_days), ('UserLocation', location_days)):
+        if days > 0:
+            __retention[table] = days
+    __partitions_ahead = partitions_ahead
+
+
+def _partitions(session, table: str) -> Optional[List[Tuple[str, Optional[datetime]]]]:
+    """
+    Table's partitions in order
+    :return: (name, upper bound) pairs, bound None for MAXVALUE,
+             or None if table isn't partitioned
+    """
+    if session.bind.dialect.name != 'mysql':
+        return None
+    rows = session.execute(
+        text('SELECT PARTITION_NAME, PARTITION_DESCRIPTION FROM information_schema.PARTITIONS '
+             'WHERE TABLE_SCHEMA = DATABASE() AND TABLE_NAME = :table AND PARTITION_NAME IS NOT NULL '
+             'ORDER BY PARTITION_ORDINAL_POSITION'),
+        dict(table=table)).fetchall()
+    if not rows:
+        return None
+    return [(name, None if bound == 'MAXVALUE' else datetime.strptime(bound.strip("'"), '%Y-%m-%d %H:%M:%S'))
+            for name, bound in rows]
+
+
+def _add_partitions(table: str, partitions: List[Tuple[str, Optional[datetime]]], today: date):
+    """Split the MAXVALUE partition into daily partitions through partitions_ahead days from today"""
+    if not partitions or partitions[-1][1] is not None:
+        logging.warning(f'{table} has no MAXVALUE partition, not adding partitions')
+        return
+    bounds = [bound for _, bound in partitions if bound is not None]
+    day = max(bounds).date() if bounds else today
+    last = today + timedelta(days=__partitions_ahead)
+    new = []
+    while day <= last:
+        new.append(f"PARTITION p{day:%Y%m%d} VALUES LESS THAN ('{day + timedelta(days=1):%Y-%m-%d} 00:00:00')")
+        day += timedelta(days=1)
+    if new:
+        new.append('PARTITION pmax VALUES LESS THAN (MAXVALUE)')
+        with session_scope() as session:
+            session.execute(text(f'ALTER TABLE `{table}` REORGANIZE PARTITION pmax INTO ({", ".join(new)})'))
+        logging.info(f'added {len(new) - 1} partitions to {table}')
+
+
+def _oldest_day(table: str, before: datetime, after: date=None) -> Optional[date]:
+    """Day of table's oldest row before time (and after day), if any"""
+    model, _ = TABLES[table]
+    with session_scope(readonly=True, primary=True) as session:
+        query = session.query(func.min(model.time)).filter(model.time < before)
+        if after is not None:
+            query = query.filter(model.time >= datetime.combine(after + timedelta(days=1), datetime.min.time()))
+        oldest = query.scalar()
+    if oldest is None:
+        return None
+    if isinstance(oldest, str):
+        # SQLite returns aggregates of datetimes as text
+        oldest = datetime.strptime(oldest[:19], '%Y-%m-%d %H:%M:%S')
+    return oldest.date()
+
+
+def _roll_up(table: str, until: datetime):
+    """Summarize each day with rows before until (a midnight)"""
+    _, rollup = TABLES[table]
+    day = _oldest_day(table, until)
+    while day is not None:
+        with session_scope() as session:
+            rollup(session, day)
+        day = _oldest_day(table, until, day)
+
+
+def retain(table: str, days: int, now: datetime=None) -> int:
+    """
+    Roll table's rows older than days into daily summaries, then remove them
+    :param table: retained table (see TABLES)
+    :param days: days of rows kept, counted from today's midnight (UTC)
+    :param now: current time (default: utcnow)
+    :return: number of partitions dropped or days deleted
+    """
+    today = (now or datetime.utcnow()).date()
+    cutoff = datetime.combine(today - timedelta(days=days), datetime.min.time())
+    model, rollup = TABLES[table]
+    with session_scope(readonly=True, primary=True) as session:
+        partitions = _partitions(session, table)
+
+    if partitions is None:
+        # unpartitioned: summarize and delete a day at a time
+        removed = 0
+        day = _oldest_day(table, cutoff)
+        while day is not None:
+            end = datetime.combine(day + timedelta(days=1), datetime.min.time())
+            with session_scope() as session:
+                rollup(session, day)
+                session.query(model).filter(model.time < end).delete(synchronize_session=False)
+            removed += 1
+            day = _oldest_day(table, cutoff)
+        return removed
+
+    # partitioned: summarize each expired partition's days, then drop it
+    # partitions are dropped after their summaries commit, so a failed run is repeated safely
+    expired = [(name, bound) for name, bound in partitions if bound is not None and bound <= cutoff]
+    for name, bound in expired:
+        _roll_up(table, bound)
+        with session_scope() as session:
+            session.execute(text(f'ALTER TABLE `{table}` DROP PARTITION `{name}`'))
+        logging.info(f'dropped partition {name} of {table}')
+    _add_partitions(table, partitions[len(expired):], today)
+    return len(expired)
+
+
+def run_retention(now: datetime=None):
+    """
+    Apply retention to every configured table
+    Runs in one process only (see app.main), off the IOLoop
+    """
+    if not __running.acquire(blocking=False):
+        logging.warning('retention still running, skipping')
+        return
+    try:
+        for table, days in __retention.items():
+            try:
+                removed = retain(table, days, now)
+                if removed:
+                    logging.info(f'retention: removed {removed} days of {table} older than {days} days')
+            except Exception as e:
+                logging.error(f'retention failed for {table}: {e}')
+    finally:
+        __running.release()
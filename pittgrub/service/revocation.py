@@ -0,0 +1,104 @@
+"""
+Token revocation
+Each worker keeps revocations and disabled users in memory,
+syncing from the database periodically, so authenticated
+requests are checked without a query
+"""
+
+import calendar
+import logging
+import threading
+from datetime import datetime, timedelta
+
+from db import TokenRevocation, User, session_scope
+
+
+# user id -> epoch seconds; tokens issued before are revoked
+__revoked = dict()
+
+# ids of disabled users
+__disabled = set()
+
+# time of the latest revocation loaded
+__last_time = None
+
+# revocations this long before the latest one loaded are read again on sync:
+# ids and times are assigned before commit, so rows can commit out of order
+SYNC_MARGIN = timedelta(minutes=1)
+
+__lock = threading.Lock()
+
+
+def timestamp(time: datetime) -> float:
+    """
+    Epoch seconds of a UTC time, to the millisecond
+    Used for token issue times (iat) and revocation times alike, so a token
+    issued right after a revocation, even within the same second, stays valid
+    """
+    return calendar.timegm(time.utctimetuple()) + time.microsecond // 1000 / 1000
+
+
+def _revoke(user_id: int, time: datetime):
+    cutoff = timestamp(time)
+    if __revoked.get(user_id, 0) < cutoff:
+        __revoked[user_id] = cutoff
+
+
+def init_revocations():
+    """Load all revocations and disabled users"""
+    global __disabled, __last_time
+    with session_scope(readonly=True, primary=True) as session:
+        latest = TokenRevocation.get_latest_by_user(session)
+        last_time = TokenRevocation.last_time(session)
+        disabled = set(User.get_disabled_ids(session))
+    with __lock:
+        __revoked.clear()
+        for user_id, time in latest:
+            _revoke(user_id, time)
+        __disabled = disabled
+        __last_time = last_time
+    logging.info(f'loaded revocations for {len(__revoked)} users, {len(__disabled)} disabled')
+
+
+def sync_revocations():
+    """
+    Load revocations added by other workers and refresh disabled users
+    Revocations within SYNC_MARGIN of the latest one loaded are read again,
+    so those committed late are still picked up (reloading one is a no-op)
+    """
+    global __disabled, __last_time
+    since = __last_time - SYNC_MARGIN if __last_time is not None else None
+    with session_scope(readonly=True, primary=True) as session:
+        revocations = TokenRevocation.get_since(session, since)
+        disabled = set(User.get_disabled_ids(session))
+    with __lock:
+        for user_id, time in revocations:
+            _revoke(user_id, time)
+            __last_time = max(__last_time or time, time)
+        __disabled = disabled
+
+
+def revoke_user_tokens(user_id: int):
+    """Revoke every token issued to user until now"""
+    revocation = TokenRevocation(user_id)
+    with session_scope() as session:
+        session.add(revocation)
+        time = revocation.time
+    with __lock:
+        _revoke(user_id, time)
+
+
+def is_revoked(user_id: int, issued: float) -> bool:
+    """
+    Check if token was revoked
+    :param user_id: token owner
+    :param issued: token issue time (epoch seconds, see timestamp)
+    :return: True if revoked
+        False if not
+    """
+    return issued < __revoked.get(user_id, -1)
+
+
+def is_disabled(user_id: int) -> bool:
+    """Check if user account is disabled"""
+    return user_id in __disabled
@@ -1,17 +1,28 @@
+from datetime import datetime
+from types import SimpleNamespace
 from typing import List, Optional, Union
 
+from sqlalchemy import select
+
 from db import (
     EmailList,
+    Page,
+    Property,
+    Role,
     User,
     UserFoodPreference,
     UserLocation,
+    UserRole,
     UserStatus,
     UserVerification,
+    reference,
     session_scope
 )
+from db import loader
+from db.aio import async_session_scope
 from domain.data import UserData, UserProfileData, FoodPreferenceData
 from emailer import send_verification_email
-from service.property import get_property, set_property
+from service.auth import invalidate_user_key
 from . import MissingUserError
 
 
@@ -20,82 +31,87 @@ def _is_user(session, id: int) -> bool:
     return user is not None
 
 def is_user(id: int) -> bool:
-    with session_scope() as session:
+    with session_scope(readonly=True, owner=id) as session:
         return _is_user(session, id)
 
-def get_user_verification(id: int) -> str:
-    with session_scope() as session:
+def get_user_verification(id: int) -> Optional[str]:
+    """
+    User's verification code, creating one if a user.threshold slot is left
+    Resending an existing code doesn't take a slot
+    :return: code, or None if there is no code and no slot left
+    """
+    with session_scope(owner=id) as session:
         if not _is_user(session, id):
             raise MissingUserError(f"User not found with id: {id}")
         verification = UserVerification.get_by_user(session, id)
         if verification is None:
+            if not Property.reserve(session, 'user.threshold'):
+                return None
             verification = UserVerification.add(session, user_id=id)
         return verification.code
 
-def get_user_verification_code(id: int) -> Optional[str]:
-    with session_scope() as session:
-        if not _is_user(session, id):
-            raise MissingUserError(f"User not found with id: {id}")
-        verification = UserVerification.get_by_user(session, id)
-        if verification is None:
-            return None
-        return verification.code
-
 def get_user(id: int) -> Optional[UserData]:
-    with session_scope() as session:
-        user = User.get_by_id(session, id)
+    with session_scope(readonly=True, owner=id) as session:
+        user = User.get_by_id(session, id, loader.USER)
         return None if not user else UserData(user)
 
+async def get_user_async(id: int) -> Optional[UserData]:
+    """get_user on the async connection pool (requires db.aio)"""
+    users, user_roles = User.__table__, UserRole.__table__
+    async with async_session_scope() as conn:
+        result = await conn.execute(
+            select([users.c.id, users.c.email, users.c.name, users.c.status, users.c.active, users.c.disabled])
+            .where(users.c.id == id))
+        user = await result.first()
+        if user is None:
+            return None
+        result = await conn.execute(
+            select([user_roles.c.role_id])
+            .where(user_roles.c.user_id == id))
+        role_ids = [role_id for role_id, in await result.fetchall()]
+    return UserData(SimpleNamespace(roles=reference.get_all(Role, role_ids), **user))
+
 def get_user_profile(id: int) -> Optional[UserProfileData]:
-    with session_scope() as session:
-        user = User.get_by_id(session, id)
+    with session_scope(readonly=True, owner=id) as session:
+        user = User.get_by_id(session, id, loader.USER_PROFILE)
         return None if not user else UserProfileData(user)
 
 def get_user_by_email(email: str) -> Optional[UserData]:
-    with session_scope() as session:
+    with session_scope(readonly=True) as session:
         user = User.get_by_email(session, email)
         return None if not user else UserData(user)
 
-def get_all_users() -> List[UserData]:
-    with session_scope() as session:
-        users = User.get_all(session)
-        return UserData.list(users)
+def get_all_users(limit: int, cursor: str=None) -> Page:
+    with session_scope(readonly=True) as session:
+        users, next = User.get_page(session, limit, cursor, loader.USER)
+        return Page(UserData.list(users), next)
 
 def get_user_food_preferences(id: int) -> List[FoodPreferenceData]:
-    with session_scope() as session:
+    with session_scope(readonly=True, owner=id) as session:
         food_preferences = User.get_by_id(session, id).food_preferences
         return FoodPreferenceData.list(food_preferences)
 
-def change_user_password(id: int, old_password: str, new_password: str) -> bool:
+def get_user_password_hash(id: int) -> Optional[str]:
     """
-    Changes user password from old to new
-    :param id:
-    :param old_password:
-    :param new_password:
-    :return: True if succeeded
-        False if not (invalid old_password, etc.)
+    Get password hash for verifying user credentials
+    :param id: user id
+    :return: password hash, or None if user not found
     """
-    with session_scope() as session:
-        user = User.get_by_id(session, id)
-        if user is None:
-            raise MissingUserError(f"User not found with id: {id}")
-        else:
-            if not user.verify_password(old_password):
-                return False
-            user.password = new_password
-    return True
+    with session_scope(readonly=True, primary=True) as session:
+        return session.query(User.password).filter(User.id == id).scalar()
 
 def update_user_password(id: int, password: str) -> bool:
-    with session_scope() as session:
+    with session_scope(owner=id) as session:
         user = User.get_by_id(session, id)
         if user is None:
             raise MissingUserError(f"User not found with id: {id}")
         user.password = password
+    invalidate_user_key(id)
     return True
 
 
 def update_user_profile(id: int, food: List[int] = None, pantry: bool=None, eager: int=None):
-    with session_scope() as session:
+    with session_scope(owner=id) as session:
         user = User.get_by_id(session, id)
         if food:
             UserFoodPreference.update(session, id, food)
@@ -106,14 +122,14 @@ def update_user_profile(id: int, food: List[int] = None, pantry: bool=None, eage
         session.merge(user)
 
 def update_expo_token(id: int, token: str) -> bool:
-    with session_scope() as session:
+    with session_scope(owner=id) as session:
         user = User.get_by_id(session, id)
         user.expo_token = token
     return True
 
 def verify_user(code: str, user_id: int) -> bool:
     assert code is not None
-    with session_scope() as session:
+    with session_scope(owner=user_id) as session:
         verification = UserVerification.get_by_code(session, code)
         if verification is not None and verification.user_id == user_id:
             user = verification.user
@@ -124,9 +140,15 @@ def verify_user(code: str, user_id: int) -> bool:
     return False
 
 def add_location(id: int, latitude: float, longitude: float, time: 'datetime'=None):
-    with session_scope() as session:
+    with session_scope(owner=id) as session:
         session.add(UserLocation(user=id, lat=latitude, long=longitude, time=time))
 
+async def add_location_async(id: int, latitude: float, longitude: float, time: 'datetime'=None):
+    """add_location on the async connection pool (requires db.aio)"""
+    async with async_session_scope() as conn:
+        await conn.execute(UserLocation.__table__.insert().values(
+            user_id=id, latitude=latitude, longitude=longitude, time=time or datetime.utcnow()))
+
 def add_to_email_list(email: str) -> bool:
     assert email is not None
     with session_scope() as session:
@@ -144,13 +166,10 @@ def remove_from_email_list(email: str) -> bool:
     return False
 
 def invite_next_users():
-    threshold = int(get_property('user.threshold'))
     with session_scope() as session:
         users = UserData.list(User.next_users_to_permit(session))
-        for user in users:
-            if threshold < 1:
-                break
-            code = UserVerification.add(session, user.id).code
-            send_verification_email(to=user.email, code=code)
-            threshold -= 1
-    set_property('user.threshold', str(threshold))
+        # invite as many as there are slots left once reserved
+        granted = Property.reserve(session, 'user.threshold', len(users), partial=True)
+        invites = [(user.email, UserVerification.add(session, user.id).code) for user in users[:granted]]
+    for email, code in invites:
+        send_verification_email(to=email, code=code)
@@ -1,4 +1,8 @@
 import json
+import threading
+import time
+from collections import OrderedDict
+from typing import Any, Dict, Hashable
 
 
 def json_esc(data: object, indent: int=2) -> str:
@@ -16,3 +20,74 @@ def semver_check(provided: str, supported: str) -> bool:
     p = provided.split('.')
     s = supported.split('.')
     return p[0] > s[0] or (p[0] == s[0] and (p[1] > s[1] or (p[1] == s[1] and p[2] >= s[2])))
+
+
+class LRUCache:
+    """
+    Bounded, thread-safe least-recently-used cache with optional time-to-live
+    Entries are evicted when the cache is full or once they are older than ttl
+    """
+
+    def __init__(self, maxsize: int=1024, ttl: float=None):
+        """
+        :param maxsize: maximum number of entries
+        :param ttl: seconds before an entry expires (default: None, never expires)
+        """
+        assert maxsize > 0, 'Cache size must be positive'
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key: Hashable, default: Any=None) -> Any:
+        """
+        Get cached value, refreshing its position
+        :param key: cache key
+        :param default: value if key is missing or expired
+        :return: cached value, or default
+        """
+        with self._lock:
+            entry = self._data.get(key)
+            if entry is not None:
+                value, expires = entry
+                if expires is None or expires > time.monotonic():
+                    self._data.move_to_end(key)
+                    self.hits += 1
+                    return value
+                del self._data[key]
+            self.misses += 1
+            return default
+
+    def put(self, key: Hashable, value: Any, ttl: float=None) -> None:
+        """
+        Add value to cache, evicting the least recently used entry if full
+        :param key: cache key
+        :param value: value to cache
+        :param ttl: seconds before entry expires (default: cache ttl)
+        """
+        ttl = ttl if ttl is not None else self.ttl
+        expires = time.monotonic() + ttl if ttl is not None else None
+        with self._lock:
+            self._data[key] = (value, expires)
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+
+    def invalidate(self, key: Hashable) -> None:
+        """Remove key from cache, if present"""
+        with self._lock:
+            self._data.pop(key, None)
+
+    def clear(self) -> None:
+        """Remove all entries"""
+        with self._lock:
+            self._data.clear()
+
+    def __len__(self) -> int:
+        return len(self._data)
+
+    def stats(self) -> Dict[str, int]:
+        """Cache counters for sizing"""
+        return dict(size=len(self._data), maxsize=self.maxsize, hits=self.hits, misses=self.misses)
@@ -16,9 +16,9 @@ setup(
     license='TBD',
     packages=['pittgrub/'],
     install_requires=[
-        'tornado>=4.5.1',
+        'tornado>=5.0',
         'pymysql>=0.7.11',
-        'sqlalchemy>=1.1.14',
+        'sqlalchemy>=1.2.0',
         'passlib>=1.7.1',
         'bcrypt>=3.1.3',
         'pyjwt>=1.5.2',
@@ -30,6 +30,9 @@ setup(
         'inflect>=0.2.5',
         #'flake8>=3.3.0'
     ],
+    extras_require={
+        'async': ['aiomysql>=0.0.20'],
+    },
     tests_require=[
         #'flake8>=3.3.0',
         'nose>=1.3.7',
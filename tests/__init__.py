@@ -0,0 +1,5 @@
+import os
+import sys
+
+# modules import each other from pittgrub/, as when the server runs
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'pittgrub'))
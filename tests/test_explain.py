@@ -0,0 +1,34 @@
+"""
+Hot queries are served by indexes, not full table scans
+"""
+
+import contextlib
+import io
+import unittest
+
+import db
+from db import explain
+
+
+class ExplainTest(unittest.TestCase):
+
+    def setUp(self):
+        db.init(uri='sqlite://')
+
+    def check(self, names=None):
+        """check(), returning (passed, report)"""
+        report = io.StringIO()
+        with contextlib.redirect_stdout(report):
+            passed = explain.check(names)
+        return passed, report.getvalue()
+
+    def test_hot_queries_use_indexes(self):
+        passed, report = self.check()
+        self.assertTrue(passed, report)
+
+    def test_missing_index_is_a_full_scan(self):
+        with db.session_scope() as session:
+            session.execute('DROP INDEX ix_Event_end_date_start_date')
+        passed, report = self.check(['Event.get_all_active'])
+        self.assertFalse(passed, report)
+        self.assertIn('FULL SCAN of Event', report)
@@ -0,0 +1,42 @@
+"""
+Secure handlers answer 401 unless the request carries a valid bearer token
+"""
+
+from tornado import web
+from tornado.testing import AsyncHTTPTestCase
+
+from handlers.base import SecureHandler
+from service.auth import JwtTokenService
+
+
+class OwnerHandler(SecureHandler):
+
+    def get(self):
+        self.success(200, dict(owner=self.auth.owner))
+        self.finish()
+
+
+class SecureHandlerTest(AsyncHTTPTestCase):
+
+    def get_app(self):
+        self.token_service = JwtTokenService('secret')
+        return web.Application([(r'/secure', OwnerHandler, dict(token_service=self.token_service))])
+
+    def assertStatus(self, status: int, headers: dict=None):
+        response = self.fetch('/secure', headers=headers)
+        self.assertEqual(response.code, status, response.body)
+        return response
+
+    def test_missing_header(self):
+        self.assertStatus(401)
+
+    def test_not_bearer(self):
+        self.assertStatus(401, {'Authorization': 'Basic abc'})
+
+    def test_invalid_token(self):
+        self.assertStatus(401, {'Authorization': 'Bearer abc'})
+
+    def test_valid_token(self):
+        token = self.token_service.create_access_token(7, roles=['User']).decode()
+        response = self.assertStatus(200, {'Authorization': f'Bearer {token}'})
+        self.assertIn(b'7', response.body)
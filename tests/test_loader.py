@@ -0,0 +1,82 @@
+"""
+Loader profiles keep list endpoints at a constant number of queries,
+however many rows they return
+"""
+
+import datetime
+import math
+import unittest
+
+import db
+from db import querystats
+from service.admin import get_pending_host_requests
+from service.event import get_active_by_user
+from service.user import get_all_users
+
+# bcrypt_sha256 of 'password', so seeding doesn't hash per user
+PASSWORD = '$bcrypt-sha256$v=2,t=2b,r=12$rO2HqKcmcnRT9ZpFReR5wu$R1C5lzZaoi56KU8J9MyCUrxt/oanJXG'
+
+# ids per IN (...) query of a selectin loader
+SELECTIN_BATCH = 500
+
+
+def seed(n: int):
+    """Fresh database with n users, each with a role, a host request and an event"""
+    db.init(uri='sqlite://')
+    now = datetime.datetime.utcnow()
+    ids = range(1, n + 1)
+    with db.session_scope() as session:
+        db.User.bulk_insert(session, [
+            dict(id=i, email=f'user{i}@pitt.edu', password=PASSWORD, name=f'User {i}',
+                 status=db.UserStatus.ACCEPTED, active=True, login_count=0, primary_affiliation=1)
+            for i in ids])
+        db.UserRole.bulk_insert(session, [dict(user_id=i, role_id=1) for i in ids])
+        db.UserHostRequest.bulk_insert(session, [
+            dict(id=i, user_id=i, primary_affiliation=1, reason='hosting', created=now) for i in ids])
+        db.Event.bulk_insert(session, [
+            dict(id=i, organizer_id=i, title=f'Event {i}', start_date=now + datetime.timedelta(minutes=i),
+                 end_date=now + datetime.timedelta(days=1), address='address', location='location',
+                 servings=10, created=now)
+            for i in ids])
+        db.EventFoodPreference.bulk_insert(session, [dict(event_id=i, foodpref_id=1 + i % 4) for i in ids])
+        db.UserAcceptedEvent.bulk_insert(session, [dict(event_id=i, user_id=1) for i in ids if i % 2])
+        db.UserRecommendedEvent.bulk_insert(session, [dict(event_id=i, user_id=1) for i in ids if i % 3])
+
+
+def count_queries(n: int, fn, *args) -> int:
+    """Statements fn runs for a page of all n rows"""
+    stats = querystats.QueryStats()
+    page = querystats.run(stats, fn, *args, n)
+    assert len(page.items) == n, f'{fn.__name__} returned {len(page.items)} of {n} rows'
+    assert page.next is None
+    return stats.count
+
+
+class LoaderQueryCountTest(unittest.TestCase):
+    SIZES = (10, 1000)
+
+    def assertConstantQueries(self, fn, *args, selectin: int=0):
+        """
+        Assert fn runs as many statements for the largest list as for the smallest
+        :param selectin: selectin loaders fn uses, which add a query per batch of ids
+        """
+        counts = dict()
+        for n in self.SIZES:
+            seed(n)
+            counts[n] = count_queries(n, fn, *args)
+        small, large = self.SIZES
+        batches = math.ceil(large / SELECTIN_BATCH) - math.ceil(small / SELECTIN_BATCH)
+        self.assertEqual(counts[large], counts[small] + selectin * batches, counts)
+
+    def test_get_active_by_user(self):
+        self.assertConstantQueries(get_active_by_user, 1)
+
+    def test_get_pending_host_requests(self):
+        self.assertConstantQueries(get_pending_host_requests)
+
+    def test_get_all_users(self):
+        self.assertConstantQueries(get_all_users, selectin=1)
+
+
+if __name__ == '__main__':
+    unittest.main()